@@ -0,0 +1,58 @@
+""" Measures the peak memory of generate_enemies_json with the json and the ndjson format. Every format is run
+    in a forked process of its own and the growth of the peak RSS is reported. Runs in a temporary test database.
+    Run with: DJANGO_SETTINGS_MODULE=mythras_eg.settings python benchmark_ndjson.py
+"""
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mythras_eg.settings")
+import django
+django.setup()
+import multiprocessing
+import resource
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import RequestFactory, override_settings
+
+from enemygen.models import EnemyTemplate, Race, Ruleset
+from enemygen import views
+
+AMOUNT = 10000
+
+
+def measure(template_id, output_format, queue):
+    request = RequestFactory().get('/generate_enemies_json/', {'id': template_id, 'amount': AMOUNT, 'format': output_format})
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    response = views.generate_enemies_json(request)
+    size = 0
+    if response.streaming:
+        for chunk in response.streaming_content:
+            size += len(chunk)
+    else:
+        size = len(response.content)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((after - before, size))
+
+
+def main():
+    old_name = connection.creation.create_test_db(verbosity=0, keepdb=False)
+    try:
+        call_command('loaddata', 'enemygen_testdata.json', verbosity=0)
+        user = User.objects.create(username='benchmark')
+        et = EnemyTemplate.create(user, Ruleset.objects.get(id=1), Race.objects.get(name='Human'), 'Benchmark')
+        connections.close_all()
+        print('amount=%s' % AMOUNT)
+        for output_format in ('json', 'ndjson'):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(et.id, output_format, queue))
+            process.start()
+            growth, size = queue.get()
+            process.join()
+            print('%-6s peak RSS growth %7.1f MB, response %6.1f MB' % (output_format, growth / 1024.0, size / 1024.0 ** 2))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    with override_settings(DEBUG=False):
+        main()
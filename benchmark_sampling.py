@@ -0,0 +1,51 @@
+""" Compares the weighted sampling in enemygen_lib with the earlier implementation that scanned the whole
+    list once per selected item. Run with: python benchmark_sampling.py
+"""
+from collections import namedtuple
+import random
+import timeit
+
+from enemygen.enemygen_lib import select_random_items, WeightedSampler
+
+Item = namedtuple('Item', 'name probability')
+SIZES = (10, 100, 1000)
+
+
+def old_select_random_items(item_list, amount):
+    output = []
+    selected_items = []
+    for x in range(amount):
+        item = old_select_random_item(item_list, selected_items)
+        selected_items.append(item)
+        output.append(item)
+    output.sort(key=lambda item: item.name)
+    return output
+
+
+def old_select_random_item(items, exclude=()):
+    weight_total = 0
+    for item in items:
+        if item not in exclude:
+            weight_total += item.probability
+    n = random.randint(1, weight_total)
+    for item in items:
+        if item not in exclude:
+            if n <= item.probability:
+                return item
+            n -= item.probability
+
+
+def main():
+    print('%6s %6s %12s %12s %12s' % ('n', 'k', 'old ms', 'new ms', 'fenwick ms'))
+    for n in SIZES:
+        items = [Item('item%05d' % i, random.randint(1, 100)) for i in range(n)]
+        k = n // 2
+        runs = max(1, 2000 // n)
+        old = timeit.timeit(lambda: old_select_random_items(items, k), number=runs) / runs
+        new = timeit.timeit(lambda: select_random_items(items, k), number=runs) / runs
+        fenwick = timeit.timeit(lambda: WeightedSampler(items).sample(k), number=runs) / runs
+        print('%6s %6s %12.3f %12.3f %12.3f' % (n, k, old * 1000, new * 1000, fenwick * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Compares EnemyTemplate.search with the trigram index to the former icontains search over name, race name and
+    tag name. Creates TEMPLATES published templates in a temporary test database, indexes them in bulk and times
+    every query with both searches. Run with: DJANGO_SETTINGS_MODULE=mythras_eg.settings python benchmark_search.py
+"""
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mythras_eg.settings")
+import django
+django.setup()
+import io
+import random
+import time
+
+from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from taggit.models import Tag, TaggedItem
+
+from enemygen.models import EnemyTemplate, Race, Ruleset, SearchTrigram
+
+TEMPLATES = 100000
+QUERIES = ('pirate', 'captain -sea', 'orc', 'ab', 'troll shaman', 'nothingsuchhere')
+ROUNDS = 5
+WORDS = ('pirate', 'captain', 'bandit', 'guard', 'shaman', 'warrior', 'archer', 'priest', 'thief', 'knight',
+         'raider', 'scout', 'brute', 'sorcerer', 'hunter', 'troll', 'orc', 'goblin', 'cultist', 'mercenary')
+TAGS = ('sea', 'forest', 'city', 'undead', 'mountain', 'desert', 'swamp', 'boss', 'minion', 'elite')
+
+
+def legacy_search(string, user):
+    """ The search before the index: an icontains filter per word over name, race name and tag name """
+    queryset = EnemyTemplate.objects.filter(published=True).select_related('owner', 'race').exclude(race__name='Cult')
+    for word in string.strip().split(' '):
+        if word[0] == '-':
+            word = word[1:]
+            queryset = queryset.exclude(name__icontains=word)
+            queryset = queryset.exclude(race__name__icontains=word)
+            queryset = queryset.exclude(tags__name__icontains=word)
+        else:
+            queryset = queryset.filter(Q(name__icontains=word) | Q(race__name__icontains=word) | Q(tags__name__icontains=word))
+    return queryset.distinct()
+
+
+def create_templates(rng):
+    user = User.objects.create(username='benchmark')
+    ruleset = Ruleset.objects.get(id=1)
+    races = list(Race.objects.exclude(name='Cult'))
+    tags = [Tag.objects.create(name=name, slug=name) for name in TAGS]
+    templates = []
+    template_tags = []
+    for i in range(TEMPLATES):
+        name = '%s %s %s' % (rng.choice(WORDS).title(), rng.choice(WORDS).title(), i)
+        race = rng.choice(races)
+        template_tags.append(rng.sample(tags, 2))
+        text = '\n'.join([race.name, name] + sorted(tag.name for tag in template_tags[-1])).lower() + '\n'
+        templates.append(EnemyTemplate(name=name, owner=user, ruleset=ruleset, race=race, published=True,
+                                       search_text=text))
+    EnemyTemplate.objects.bulk_create(templates, batch_size=5000)
+    content_type = ContentType.objects.get_for_model(EnemyTemplate)
+    items = []
+    trigrams = []
+    for et, et_tags in zip(EnemyTemplate.objects.filter(owner=user).order_by('id'), template_tags):
+        items.extend(TaggedItem(tag=tag, content_type=content_type, object_id=et.id) for tag in et_tags)
+        trigrams.extend(SearchTrigram(template=et, trigram=trigram) for trigram in SearchTrigram.trigrams(et.search_text))
+    TaggedItem.objects.bulk_create(items, batch_size=5000)
+    SearchTrigram.objects.bulk_create(trigrams, batch_size=5000)
+    return len(trigrams)
+
+
+def timed(search, string):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        ids = set(search(string, AnonymousUser()).values_list('id', flat=True))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ids
+
+
+def main():
+    old_name = connection.creation.create_test_db(verbosity=0, keepdb=False)
+    try:
+        call_command('loaddata', 'enemygen_testdata.json', verbosity=0)
+        call_command('update_search_index', stdout=io.StringIO())
+        start = time.perf_counter()
+        trigrams = create_templates(random.Random(1))
+        print('templates=%s trigrams=%s (built in %.1f s)' % (TEMPLATES, trigrams, time.perf_counter() - start))
+        for string in QUERIES:
+            legacy_time, legacy_ids = timed(legacy_search, string)
+            index_time, index_ids = timed(EnemyTemplate.search, string)
+            print('%-16s results=%6s  icontains %8.1f ms  index %8.1f ms  same=%s'
+                  % (string, len(index_ids), legacy_time * 1000, index_time * 1000, legacy_ids == index_ids))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+""" Times the earlier statistics computation against the grouped queries of views_lib.compute_statistics
+    on a synthetic data set. Runs in a temporary test database.
+    Run with: DJANGO_SETTINGS_MODULE=mythras_eg.settings python benchmark_statistics.py
+"""
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mythras_eg.settings")
+import django
+django.setup()
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+
+from enemygen.models import EnemyTemplate, Race, Ruleset
+from enemygen.views_lib import compute_statistics
+
+USERS = 50000
+TEMPLATES = 5000
+CULTS = 200
+
+
+def old_statistics():
+    templates = EnemyTemplate.objects.filter(published=True).exclude(race__name='Cult')
+    cults = EnemyTemplate.objects.filter(published=True, race__name='Cult')
+    races = Race.objects.filter(published=True)
+    races_stats = list({'name': r.name, 'id': r.id, 'template_amount': len(r.templates)} for r in races if r.templates)
+    races_stats = sorted(races_stats, reverse=True, key=lambda r: r['template_amount'])
+    users = list({'name': u.username, 'template_amount': len(templates.filter(owner=u))} for u in User.objects.all())
+    users = sorted(users, reverse=True, key=lambda item: item['template_amount'])
+    users = list(user for user in users if user['template_amount'] > 0)
+    clts = list({'name': c.name, 'id': c.id, 'rank': c.get_cult_rank_display(), 'rank_int': c.cult_rank} for c in cults)
+    clts = sorted(clts, reverse=False, key=lambda et: et['name'])
+    return {'templates': list(templates.filter(generated__gt=29).order_by('-generated')),
+            'races': races_stats,
+            'users': users,
+            'cults': clts,
+            'total_published_templates': templates.count(),
+            'total_published_races': races.count(),
+            'total_published_cults': cults.count(),
+            'common_cults': cults.filter(cult_rank=1).count(),
+            'dedicated_cults': cults.filter(cult_rank=2).count(),
+            'proven_cults': cults.filter(cult_rank=3).count(),
+            'overseer_cults': cults.filter(cult_rank=4).count(),
+            'leader_cults': cults.filter(cult_rank=5).count()}
+
+
+def create_data():
+    User.objects.bulk_create(User(username='user%s' % i) for i in range(USERS))
+    users = list(User.objects.values_list('id', flat=True))
+    ruleset = Ruleset.objects.get(id=1)
+    races = list(Race.objects.exclude(name='Cult'))
+    cult_race, _ = Race.objects.get_or_create(name='Cult', defaults={'owner_id': users[0], 'published': True})
+    EnemyTemplate.objects.bulk_create(
+        EnemyTemplate(name='Template %s' % i, owner_id=users[(i * 7) % len(users)], ruleset=ruleset,
+                      race=races[i % len(races)], published=True, generated=i % 100)
+        for i in range(TEMPLATES))
+    EnemyTemplate.objects.bulk_create(
+        EnemyTemplate(name='Cult %s' % i, owner_id=users[i], ruleset=ruleset, race=cult_race, published=True,
+                      cult_rank=i % 6)
+        for i in range(CULTS))
+
+
+def timed(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def main():
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        call_command('loaddata', 'enemygen_testdata.json', verbosity=0)
+        create_data()
+        print('%s users, %s templates, %s cults' % (USERS, TEMPLATES, CULTS))
+        print('old: %.2f s' % timed(old_statistics))
+        print('new: %.2f s' % timed(compute_statistics))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -102,6 +102,13 @@ class HitLocationAdmin(admin.ModelAdmin):
     list_filter = ('race',)
     ordering = ('race', 'range_start',)
 
+class CounterAdmin(admin.ModelAdmin):
+    list_display = ('name', 'value')
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('html_file', 'status', 'created', 'finished')
+    list_filter = ('status',)
+
 admin.site.register(EnemyTemplate, EnemyTemplateAdmin)
 admin.site.register(Weapon, WeaponAdmin)
 admin.site.register(CombatStyle, CombatStyleAdmin)
@@ -129,4 +136,6 @@ admin.site.register(EnemyStat, EnemyStatAdmin)
 admin.site.register(SpellAbstract, SpellAbstractAdmin)
 admin.site.register(EnemySpell, EnemySpellAdmin)
 admin.site.register(Star, StarAdmin)
-admin.site.register(m.EnemyCult)
\ No newline at end of file
+admin.site.register(m.EnemyCult)
+admin.site.register(m.Counter, CounterAdmin)
+admin.site.register(m.ExportJob, ExportJobAdmin)
\ No newline at end of file
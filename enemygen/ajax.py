@@ -1,7 +1,6 @@
 # pylint: disable=no-member
 
 from django.http import JsonResponse
-from django.conf import settings
 from django.contrib.auth.decorators import login_required
 
 from enemygen.models import EnemyStat, EnemySkill, EnemyTemplate
@@ -10,15 +9,13 @@ from enemygen.models import CombatStyle, Weapon, CustomSpell, EnemyWeapon, Custo
 from enemygen.models import Race, RaceStat, HitLocation, CustomSkill, Party, TemplateToParty, EnemySpirit
 from enemygen.models import EnemyAdditionalFeatureList, PartyAdditionalFeatureList, AdditionalFeatureList
 from enemygen.models import EnemyNonrandomFeature, PartyNonrandomFeature, EnemyCult
-from enemygen.views_lib import weapons
+from enemygen.views_lib import weapons, encounter_file_name, sanitize_html_path, add_sheet_edit, search_templates
 from enemygen.dice import Dice
-from enemygen.enemygen_lib import to_bool
+from enemygen.enemygen_lib import to_bool, ValidationError
 
 import logging
 import json
 import html
-import os
-from bs4 import BeautifulSoup
 
 
 @login_required
@@ -27,11 +24,8 @@ def apply_notes_to_templates(request, race_id):
     notes = body['notes']
     try:
         race = Race.objects.get(id=int(race_id))
-        for et in EnemyTemplate.objects.filter(race=race, owner=request.user):
-            if notes not in et.notes:
-                et.notes = et.notes + '\n' + notes
-                et.save()
-        return JsonResponse({'success': True})
+        changed = race.apply_notes_to_templates(notes, request.user)
+        return JsonResponse({'success': True, 'changed': changed})
     except Exception as e:
         return JsonResponse({'error': str(e)})
 
@@ -142,8 +136,8 @@ def add_custom_weapon(request, cs_id, type):
 @login_required
 def add_hit_location(request, race_id):
     try:
-        HitLocation.create(race_id)
-        return JsonResponse({'success': True})
+        _, changed = Race.objects.get(id=int(race_id)).add_hit_location()
+        return JsonResponse({'success': True, 'changed': changed})
     except Exception as e:
         return JsonResponse({'error': str(e)})
 
@@ -630,22 +624,22 @@ def submit(request, id):
 
 def change_template(request):
     """ Changes the name of the generated enemy, in the given html
-        Input: html_file    - name of the html file to modify
+        Input: encounter    - the generated encounter, or
+               html_file    - name of the html file to modify
                id           - id of the html element to modify
                value        - new value
     """
     body = json.loads(request.body)
-    html_file = html.unescape(settings.TEMP + os.path.sep + body['html_file'])
-    id = body['id']
-    value = body['value']
-    with open(html_file, 'r') as ff:
-        soup = BeautifulSoup(ff, 'html.parser')
-    span_tag = soup.find('span', {'id': id})
-    klasses = ' '.join(span_tag['class'])
-    new_tag = BeautifulSoup('<span id="%s" class="%s">%s</span>' % (id, klasses, value), 'html.parser').span
-    soup.find('span', {'id': id}).replaceWith(new_tag)
-    with open(html_file, 'w') as ff:
-        ff.write(soup.prettify())
+    try:
+        if body.get('encounter'):
+            _, html_file = encounter_file_name(body['encounter'])
+        else:
+            html_file = sanitize_html_path(html.unescape(body['html_file']))
+    except ValidationError as e:
+        return JsonResponse({'error': str(e)})
+    if not html_file:
+        return JsonResponse({'error': 'Invalid html file'})
+    add_sheet_edit(html_file, body['id'], body['value'])
     return JsonResponse({'html_file': html_file})
 
 
@@ -659,9 +653,18 @@ def toggle_star(request, et_id):
 
 def search(request):
     params = request.GET
-    templs = EnemyTemplate.search(params.get('string', ''), request.user, params.getlist('rank_filter[]', []), params.getlist('cult_rank_filter[]', []))
-    templates = [et.summary_dict(request.user) for et in templs]
-    return JsonResponse({'results': templates, 'success': True})
+    try:
+        templs, next_cursor = search_templates(params.get('string', ''), request.user,
+                                               params.getlist('rank_filter[]', []), params.getlist('cult_rank_filter[]', []),
+                                               params.get('cursor'), params.get('page_size'))
+    except (ValidationError, ValueError) as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    templates = []
+    for et in templs:
+        summary = et.summary_dict()
+        summary['starred'] = et.starred
+        templates.append(summary)
+    return JsonResponse({'results': templates, 'next': next_cursor, 'success': True})
 
 
 def get_weapons(request, cs_id):
@@ -5,23 +5,61 @@ Handles dice.
 import random
 import re
 from collections import OrderedDict
+from functools import lru_cache
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How many distinct (stat-replaced) dice expressions are kept parsed in memory per process
+PARSE_CACHE_SIZE = 4096
 
 
 class Dice:
     def __init__(self, dice_set):
         self.dice_set = dice_set.upper()
-        self.components = self._dissect()
+        self.components = _compile(self.dice_set)
     
-    def roll(self):
+    def roll(self, rng=None):
+        """ rng is an optional random.Random instance. The random module is used by default. """
+        return self._roll(rng or random)
+
+    def _roll(self, rng):
         output = 0
         for comp in self.components:
             if isinstance(comp, int):
                 output += comp
             elif isinstance(comp, tuple):
                 for i in range(comp[2]):
-                    output += random.randint(comp[0], comp[1])
+                    output += rng.randint(comp[0], comp[1])
         return output
-        
+
+    def roll_many(self, n, rng=None):
+        """ Rolls the dice set n times. Each die component is drawn for all the n rolls at once.
+            rng can be a numpy.random.Generator or a random.Random instance.
+            Returns a NumPy array of the n totals, or a list if NumPy is not installed.
+        """
+        if numpy is None:
+            rng = rng or random
+            return [self._roll(rng) for _ in range(n)]
+        rng = _numpy_rng(rng)
+        totals = numpy.zeros(n, dtype=numpy.int64)
+        for comp in self.components:
+            if isinstance(comp, int):
+                totals += comp
+            elif isinstance(comp, tuple):
+                totals += rng.integers(comp[0], comp[1], size=(n, comp[2]), endpoint=True).sum(axis=1)
+        return totals
+
+    def min_roll(self):
+        output = 0
+        for comp in self.components:
+            if isinstance(comp, int):
+                output += comp
+            elif isinstance(comp, tuple):
+                output += comp[0] * comp[2]
+        return output
+
     def max_roll(self):
         output = 0
         for comp in self.components:
@@ -32,20 +70,141 @@ class Dice:
                     output += comp[1]
         return output
 
+    def distribution(self):
+        """ Returns the exact probability Distribution of the dice set """
+        return _distribution(self.dice_set, ())
+
     def _dissect(self):
         """ Analyses the input string and splits it into dice roll components.
             Simple ints's will stay simple int's, dice are split into tuples of 
             three int's. For excample 10+D6 should result in [10, (1,6,1)]
         """
-        raw_components = re.findall(r"[\+\-]?[\w']+", self.dice_set)
-        fin_components = []
-        for comp in raw_components:
-            try:
-                comp = int(comp)
-            except ValueError:
-                comp = _die_to_tuple(comp)
-            fin_components.append(comp)
-        return fin_components
+        return _parse(self.dice_set)
+
+
+class Distribution:
+    """ Exact probability distribution of a dice set. Built from the counts of equally likely outcomes
+        giving each total, so no precision is lost until a probability is asked for.
+    """
+    def __init__(self, counts):
+        self.counts = tuple(sorted((total, count) for total, count in counts.items() if count))
+        self.outcomes = sum(count for _, count in self.counts)
+
+    @property
+    def pmf(self):
+        """ OrderedDict of total: probability """
+        return OrderedDict((total, count / self.outcomes) for total, count in self.counts)
+
+    @property
+    def min(self):
+        return self.counts[0][0]
+
+    @property
+    def max(self):
+        return self.counts[-1][0]
+
+    @property
+    def mean(self):
+        return sum(total * count for total, count in self.counts) / self.outcomes
+
+    @property
+    def variance(self):
+        total_sum = sum(total * count for total, count in self.counts)
+        square_sum = sum(total * total * count for total, count in self.counts)
+        return (square_sum * self.outcomes - total_sum * total_sum) / (self.outcomes * self.outcomes)
+
+    def percentile(self, percent):
+        """ Returns the smallest total, that is rolled or undercut with at least the given percent of probability """
+        cumulative = 0
+        for total, count in self.counts:
+            cumulative += count
+            if cumulative * 100 >= percent * self.outcomes:
+                return total
+        return self.max
+
+    def __add__(self, other):
+        """ Sum of two independent distributions """
+        counts = {}
+        for total, count in self.counts:
+            for other_total, other_count in other.counts:
+                counts[total + other_total] = counts.get(total + other_total, 0) + count * other_count
+        return Distribution(counts)
+
+    def scaled(self, multiplier):
+        """ Distribution of the same roll multiplied by the multiplier, e.g. POW+POW """
+        return Distribution({total * multiplier: count for total, count in self.counts})
+
+
+def distribution(dice_set, stats=None):
+    """ Returns the exact Distribution of the dice set. Stat names (STR, DEX...) in the dice set are
+        replaced by the distributions of the matching die sets of the stats dict, e.g. {'STR': '3d6'}
+    """
+    stats = tuple(sorted((name.upper(), str(value).upper()) for name, value in (stats or {}).items()))
+    return _distribution(dice_set.upper(), stats)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _distribution(dice_set, stats):
+    stat_die_sets = dict(stats)
+    stat_multipliers = OrderedDict()
+    output = Distribution({0: 1})
+    for comp in re.findall(r"[\+\-]?[\w']+", dice_set):
+        name = comp.lstrip('+-')
+        if name in stat_die_sets:
+            # The same stat is rolled only once per enemy, so STR+STR is 2*STR instead of two rolls
+            stat_multipliers[name] = stat_multipliers.get(name, 0) + (-1 if comp[0] == '-' else 1)
+            continue
+        for component in _parse(comp):
+            if isinstance(component, int):
+                output += Distribution({component: 1})
+            else:
+                die = Distribution({value: 1 for value in range(component[0], component[1] + 1)})
+                for i in range(component[2]):
+                    output += die
+    for name, multiplier in stat_multipliers.items():
+        output += _distribution(stat_die_sets[name], ()).scaled(multiplier)
+    return output
+
+
+def _parse(dice_set):
+    raw_components = re.findall(r"[\+\-]?[\w']+", dice_set)
+    fin_components = []
+    for comp in raw_components:
+        try:
+            comp = int(comp)
+        except ValueError:
+            comp = _die_to_tuple(comp)
+        fin_components.append(comp)
+    return fin_components
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _compile(dice_set):
+    """ Parses the given (upper case) dice set once per process. The components are returned as a tuple,
+        so that the cached value can be safely shared between Dice instances and threads.
+    """
+    return tuple(_parse(dice_set))
+
+
+def _numpy_rng(rng):
+    """ Returns a numpy Generator for the given rng. A random.Random is used to seed a new Generator,
+        so that seeded rolls stay reproducible.
+    """
+    if rng is None:
+        return numpy.random.default_rng()
+    if isinstance(rng, numpy.random.Generator):
+        return rng
+    return numpy.random.default_rng(rng.getrandbits(64))
+
+
+def cache_info():
+    """ Returns the hits, misses, maxsize and currsize of the dice expression parse cache """
+    return _compile.cache_info()
+
+
+def clear_cache():
+    _compile.cache_clear()
+    _distribution.cache_clear()
 
 
 def clean(dieset):
@@ -1,37 +1,105 @@
 import random
+import heapq
+import math
 
 
-def select_random_items(item_list, amount):
+def select_random_items(item_list, amount, rng=None):
     """ Randomly selects the given amount of items from the given list
         Input: item_list: List of items where to pick from. The items on the list need to have the attribute
                'probability'
                amount: amount of items to be selected
+               rng: Optional random.Random instance
+        Uses Efraimidis-Spirakis keys: every item gets the key log(u)/probability and the items with the
+        largest keys are selected. That's one pass over the list instead of one pass per selected item.
     """
-    output = []
-    selected_items = []
-    for x in range(amount):
-        item = select_random_item(item_list, selected_items)
-        selected_items.append(item)
-        output.append(item)
+    if amount <= 0:
+        return []
+    rng = rng or random
+    keyed = []
+    for item in item_list:
+        if item.probability > 0:
+            keyed.append((math.log(1.0 - rng.random()) / item.probability, len(keyed), item))
+    if amount > len(keyed):
+        raise ValueError('Cannot select %s items from %s items with positive probability' % (amount, len(keyed)))
+    output = [item for _, _, item in heapq.nlargest(amount, keyed)]
     output.sort(key=lambda item: item.name)
     return output
 
 
-def select_random_item(items, exclude=()):
+def select_random_item(items, exclude=(), rng=None):
     """ Input: List of items. The items need to have attribute 'probability' of type int 
                Optional: Items to be excluded
+               Optional: random.Random instance
         Output: Randomly selected item from the list, based on the item probability
     """
+    rng = rng or random
+    try:
+        exclude = set(exclude)
+    except TypeError:  # Unsaved model instances are not hashable
+        pass
+    candidates = [item for item in items if item not in exclude]
     weight_total = 0
-    for item in items:
-        if item not in exclude:
-            weight_total += item.probability
-    n = random.randint(1, weight_total)
-    for item in items:
-        if item not in exclude:
-            if n <= item.probability:
-                return item
-            n -= item.probability
+    for item in candidates:
+        weight_total += item.probability
+    n = rng.randint(1, weight_total)
+    for item in candidates:
+        if n <= item.probability:
+            return item
+        n -= item.probability
+
+
+class WeightedSampler(object):
+    """ Repeated weighted draws from the same list in O(log n) per draw.
+        The weights are kept in a Fenwick tree, so drawn items can also be removed in O(log n).
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.weights = [max(item.probability, 0) for item in self.items]
+        self.total = sum(self.weights)
+        size = len(self.items)
+        self.tree = [0] * (size + 1)
+        for i, weight in enumerate(self.weights, 1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= size:
+                self.tree[parent] += self.tree[i]
+        self.step = 1
+        while self.step * 2 <= size:
+            self.step *= 2
+
+    def __len__(self):
+        return len([weight for weight in self.weights if weight > 0])
+
+    def draw(self, rng=None, remove=False):
+        """ Returns a random item based on the item probabilities. If remove is True the item can't be
+            drawn again.
+        """
+        n = (rng or random).randint(1, self.total)
+        index = 0
+        step = self.step
+        while step:
+            if index + step < len(self.tree) and self.tree[index + step] < n:
+                index += step
+                n -= self.tree[index]
+            step //= 2
+        if remove:
+            self._remove(index)
+        return self.items[index]
+
+    def sample(self, amount, rng=None):
+        """ Returns the given amount of different items, sorted by name """
+        output = [self.draw(rng, remove=True) for _ in range(amount)]
+        output.sort(key=lambda item: item.name)
+        return output
+
+    def _remove(self, index):
+        weight = self.weights[index]
+        self.weights[index] = 0
+        self.total -= weight
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] -= weight
+            i += i & -i
 
 
 class ValidationError(Exception):
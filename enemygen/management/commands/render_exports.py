@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, close_old_connections
+
+from enemygen.models import ExportJob
+from enemygen.views_lib import process_export_job
+
+import logging
+import multiprocessing
+import time
+
+
+class Command(BaseCommand):
+    help = ('Renders the queued PDF exports with a pool of long-lived worker processes. '
+            'The number of workers bounds the number of concurrent renderings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'EXPORT_WORKERS', 2))
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Render the queued jobs in this process and exit')
+
+    def handle(self, *args, **options):
+        ExportJob.requeue_stale(getattr(settings, 'EXPORT_JOB_TIMEOUT', 300))
+        if options['once']:
+            rendered = 0
+            while process_export_job():
+                rendered += 1
+            self.stdout.write('Rendered %s jobs' % rendered)
+            return
+        connections.close_all()  # Every worker opens its own database connection
+        workers = [multiprocessing.Process(target=_work, args=(options['poll'], getattr(settings, 'EXPORT_JOB_TIMEOUT', 300)))
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+
+
+def _work(poll, timeout):
+    logger = logging.getLogger(__name__)
+    while True:
+        try:
+            if process_export_job() is None:
+                # Jobs left running by a crashed worker are queued again while the pool keeps running
+                ExportJob.requeue_stale(timeout)
+                time.sleep(poll)
+        except Exception:
+            # E.g. a lost database connection. The worker must survive it, nothing restarts it.
+            # A job left running is queued again by requeue_stale.
+            logger.exception('Export worker error')
+            close_old_connections()
+            time.sleep(poll)
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from enemygen import temp_store
+from enemygen.views_lib import delete_old_export_jobs
+
+import time
+
+
+class Command(BaseCommand):
+    help = ('Deletes expired and least recently used files under settings.TEMP, and the export jobs finished '
+            'more than settings.EXPORT_JOB_MAX_AGE seconds ago. '
+            'With --interval the sweep is repeated periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=None, help='Seconds. Default: settings.TEMP_TTL')
+        parser.add_argument('--max-bytes', type=int, default=None, help='Default: settings.TEMP_MAX_BYTES')
+        parser.add_argument('--interval', type=int, default=getattr(settings, 'TEMP_SWEEP_INTERVAL', None),
+                            help='Seconds between sweeps. Default: sweep once')
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write('Deleted %s export jobs' % delete_old_export_jobs())
+            deleted, reclaimed = temp_store.sweep(options['ttl'], options['max_bytes'])
+            self.stdout.write('Deleted %s files, reclaimed %s bytes' % (deleted, reclaimed))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from enemygen.models import EnemyTemplate
+
+
+class Command(BaseCommand):
+    help = 'Builds the search index of the templates. The index is kept up to date on every change, ' \
+           'but templates loaded with loaddata or saved before the index existed must be indexed with this.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        ids = list(EnemyTemplate.objects.values_list('id', flat=True))
+        for start in range(0, len(ids), options['batch_size']):
+            batch = EnemyTemplate.objects.filter(id__in=ids[start:start + options['batch_size']])
+            for et in batch.select_related('race').prefetch_related('tags'):
+                et.update_search_index()
+        self.stdout.write('Indexed %s templates' % len(ids))
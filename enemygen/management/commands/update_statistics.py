@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from enemygen.views_lib import update_statistics
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the statistics snapshot shown on the statistics page. Run it periodically, e.g. from cron.'
+
+    def handle(self, *args, **options):
+        statistics = update_statistics()
+        self.stdout.write('Statistics updated: %s published templates, %s users'
+                          % (statistics['total_published_templates'], len(statistics['users'])))
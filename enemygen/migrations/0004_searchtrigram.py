@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def _trigrams(text):
+    """ The trigrams of SearchTrigram.trigrams at the time of this migration """
+    trigrams = set()
+    for line in text.split('\n'):
+        padded = line + '  '
+        trigrams.update(padded[i:i + 3] for i in range(len(line)))
+    return trigrams
+
+
+def build_search_index(apps, schema_editor):
+    """ Fills the search texts and the trigrams of the existing templates, same as update_search_index """
+    EnemyTemplate = apps.get_model('enemygen', 'EnemyTemplate')
+    SearchTrigram = apps.get_model('enemygen', 'SearchTrigram')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    content_type = ContentType.objects.filter(app_label='enemygen', model='enemytemplate').first()
+    ids = list(EnemyTemplate.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        templates = list(EnemyTemplate.objects.filter(id__in=ids[start:start + BATCH_SIZE]).select_related('race'))
+        tags = {}
+        if content_type:
+            items = TaggedItem.objects.filter(content_type=content_type, object_id__in=[et.id for et in templates])
+            for object_id, tag_name in items.values_list('object_id', 'tag__name'):
+                tags.setdefault(object_id, []).append(tag_name)
+        trigrams = []
+        for et in templates:
+            et.search_text = '\n'.join([et.race.name, et.name] + sorted(tags.get(et.id, []))).lower() + '\n'
+            trigrams.extend(SearchTrigram(template_id=et.id, trigram=trigram) for trigram in _trigrams(et.search_text))
+        EnemyTemplate.objects.bulk_update(templates, ['search_text'])
+        SearchTrigram.objects.bulk_create(trigrams, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enemygen', '0003_exportjob'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0003_taggeditem_add_unique_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enemytemplate',
+            name='search_text',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='enemygen.enemytemplate')),
+            ],
+            options={
+                'index_together': {('trigram', 'template')},
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
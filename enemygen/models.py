@@ -1,16 +1,23 @@
 # pylint: disable=no-member
 
-from django.db.models import Q
-from django.db import models
+from django.db.models import Q, F, Sum, Max, Case, When, Value
+from django.db.models.functions import Coalesce, Concat
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.contrib.auth.models import User
 
 from .enemygen_lib import ValidationError, replace_die_set, select_random_items
-from .dice import Dice, clean
+from .dice import Dice, clean, distribution
 from taggit.managers import TaggableManager
+from taggit.models import Tag, TaggedItem
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import random
 import math
+import copy
+import uuid
+import datetime
 
 WEAPON_TYPE_CHOICES = (('1h-melee', '1-h Melee'), ('2h-melee', '2-h Melee'), ('ranged', 'Ranged'), ('shield', 'Shield'))
 WEAPON_SIZE_CHOICES = (('S', 'S'), ('M', 'M'), ('L', 'L'), ('H', 'H'), ('E', 'E'), ('C', 'C'))
@@ -73,20 +80,19 @@ class Race(models.Model):
     def stats(self):
         return RaceStat.objects.filter(race=self)
         
+    DEFAULT_HIT_LOCATIONS = (('Right leg', 1, 3, 0), ('Left leg', 4, 6, 0), ('Abdomen', 7, 9, 1), ('Chest', 10, 12, 2),
+                             ('Right Arm', 13, 15, -1), ('Left Arm', 16, 18, -1), ('Head', 19, 20, 0))
+
     @classmethod
     def create(cls, owner, name="New race"):
         race = cls(name=name, owner=owner)
-        race.save()
-        for stat in StatAbstract.objects.all():
-            rs = RaceStat(stat=stat, race=race, default_value='3D6')
-            rs.save()
-        HitLocation(name='Right leg', range_start=1, range_end=3, race=race, hp_modifier=0).save()
-        HitLocation(name='Left leg', range_start=4, range_end=6, race=race, hp_modifier=0).save()
-        HitLocation(name='Abdomen', range_start=7, range_end=9, race=race, hp_modifier=1).save()
-        HitLocation(name='Chest', range_start=10, range_end=12, race=race, hp_modifier=2).save()
-        HitLocation(name='Right Arm', range_start=13, range_end=15, race=race, hp_modifier=-1).save()
-        HitLocation(name='Left Arm', range_start=16, range_end=18, race=race, hp_modifier=-1).save()
-        HitLocation(name='Head', range_start=19, range_end=20, race=race, hp_modifier=0).save()
+        with transaction.atomic():
+            race.save()
+            RaceStat.objects.bulk_create([RaceStat(stat=stat, race=race, default_value='3D6')
+                                          for stat in StatAbstract.objects.all()])
+            HitLocation.objects.bulk_create([
+                HitLocation(name=name, range_start=start, range_end=end, race=race, hp_modifier=hp_modifier)
+                for name, start, end, hp_modifier in cls.DEFAULT_HIT_LOCATIONS])
         return race
         
     def set_published(self, published):
@@ -113,16 +119,44 @@ class Race(models.Model):
     def templates(self):
         return EnemyTemplate.objects.filter(race=self)
 
+    def add_hit_location(self):
+        """ Adds a hit location after the existing ones to the race and to all its templates
+            Returns a tuple of (HitLocation, number of templates changed)
+        """
+        biggest_range = max(HitLocation.objects.filter(race=self).aggregate(Max('range_end'))['range_end__max'] or 1, 1)
+        hl = HitLocation(name='New hit location', range_start=min(biggest_range + 1, 20),
+                         range_end=min(biggest_range + 3, 20), race=self)
+        with transaction.atomic():
+            hl.save()
+            changed = EnemyHitLocation.objects.bulk_create([
+                EnemyHitLocation(hit_location=hl, enemy_template_id=et_id, armor=hl.armor)
+                for et_id in self.templates.values_list('id', flat=True)])
+        return hl, len(changed)
+
+    def apply_notes_to_templates(self, notes, owner):
+        """ Appends the notes to the notes of the owner's templates of the race, unless they contain them already.
+            Returns the number of templates changed
+        """
+        if not notes:
+            return 0
+        with transaction.atomic():
+            changed = self.templates.filter(owner=owner).exclude(notes__contains=notes).update(
+                notes=Concat(Coalesce('notes', Value('')), Value('\n' + notes), output_field=models.TextField()))
+        if changed:
+            # update() sends no signals, and the notes are part of the template listings
+            bump_catalog_version()
+        return changed
+
     def clone(self, owner):
         race = Race(name='Copy of %s' % self.name, owner=owner, movement=self.movement, special=self.special)
-        race.save()
-        for stat in self.stats:
-            rs = RaceStat(stat=stat.stat, race=race, default_value=stat.default_value)
-            rs.save()
-        for loc in self.hit_locations:
-            hl = HitLocation(name=loc.name, range_start=loc.range_start, range_end=loc.range_end, 
-                             race=race, hp_modifier=loc.hp_modifier, armor=loc.armor)
-            hl.save()
+        with transaction.atomic():
+            race.save()
+            RaceStat.objects.bulk_create([RaceStat(stat_id=stat.stat_id, race=race, default_value=stat.default_value)
+                                          for stat in self.stats])
+            HitLocation.objects.bulk_create([
+                HitLocation(name=loc.name, range_start=loc.range_start, range_end=loc.range_end, race=race,
+                            hp_modifier=loc.hp_modifier, armor=loc.armor)
+                for loc in self.hit_locations])
         return race
 
 
@@ -149,19 +183,8 @@ class HitLocation(models.Model):
             
     @classmethod
     def create(cls, race_id):
-        biggest_range = 1
-        race = Race.objects.get(id=race_id)
-        for hl in HitLocation.objects.filter(race=race):
-            biggest_range = max(hl.range_end, biggest_range)
-        range_start = min(biggest_range+1, 20)
-        range_end = min(biggest_range+3, 20)
-        hl = HitLocation(name='New hit location', range_start=range_start, range_end=range_end, race=race)
-        hl.save()
-        
-        # Add the new hitlocation also to any existing templates
-        for et in race.templates:
-            EnemyHitLocation.create(hl, et)
-        
+        # The new hit location is added also to any existing templates
+        hl, _ = Race.objects.get(id=race_id).add_hit_location()
         return hl
         
     def set_armor(self, value):
@@ -196,6 +219,7 @@ class EnemyTemplate(models.Model):
     tags = TaggableManager(blank=True)
     namelist = models.ForeignKey('AdditionalFeatureList', on_delete=models.CASCADE, null=True, blank=True)
     weapon_filter = models.CharField(max_length=50, blank=True, null=True)
+    search_text = models.TextField(default='', editable=False)
     
     class Meta:
         ordering = ['name', ]
@@ -203,53 +227,69 @@ class EnemyTemplate(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """ search_text is written only by update_search_index, so that saving a stale instance doesn't write an
+            outdated search text back
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or not set(update_fields) <= {'generated', 'used'}:
+            self.forget_plan()
+        if update_fields is not None:
+            kwargs['update_fields'] = [name for name in update_fields if name != 'search_text']
+        elif not self._state.adding and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key
+                                       and field.name != 'search_text' and field.attname not in deferred]
+        super().save(*args, **kwargs)
+
     @classmethod
     def create(cls, owner, ruleset, race, name="Enemy Template"):
         enemy_template = cls(name=name, owner=owner, ruleset=ruleset, race=race)
         enemy_template.notes = race.special
         enemy_template.movement = race.movement
-        enemy_template.save()
-        if name == 'Enemy Template':
-            enemy_template.name = '%s Template %s' % (race.name, enemy_template.id)
+        with transaction.atomic():
             enemy_template.save()
-        for stat in race.stats:
-            es = EnemyStat(stat=stat.stat, enemy_template=enemy_template, die_set=stat.default_value)
-            es.save()
-        if enemy_template.is_spirit:
-            enemy_template._create_spirit_template()
-        elif enemy_template.is_cult:
-            pass
-        else:
-            enemy_template._create_normal_template()
+            if name == 'Enemy Template':
+                enemy_template.name = '%s Template %s' % (race.name, enemy_template.id)
+                enemy_template.save()
+            EnemyStat.objects.bulk_create([
+                EnemyStat(stat_id=stat.stat_id, enemy_template=enemy_template, die_set=stat.default_value)
+                for stat in race.stats])
+            if enemy_template.is_spirit:
+                enemy_template._create_spirit_template()
+            elif enemy_template.is_cult:
+                pass
+            else:
+                enemy_template._create_normal_template()
         return enemy_template
     
     def _create_normal_template(self):
         spirit_skills = ('Spectral Combat', 'Discorporate')
-        for skill in self.ruleset.skills.all().exclude(name__in=spirit_skills):
-            es = EnemySkill(skill=skill, enemy_template=self, die_set=skill.default_value, include=skill.include)
-            es.save()
-        for hit_location in self.race.hit_locations:
-            EnemyHitLocation.create(hit_location, self)
+        EnemySkill.objects.bulk_create([
+            EnemySkill(skill=skill, enemy_template=self, die_set=skill.default_value, include=skill.include)
+            for skill in self.ruleset.skills.all().exclude(name__in=spirit_skills)])
+        EnemyHitLocation.objects.bulk_create([
+            EnemyHitLocation(hit_location=hit_location, enemy_template=self, armor=hit_location.armor)
+            for hit_location in self.race.hit_locations])
         cs = CombatStyle(name="Primary Combat Style", enemy_template=self)
         cs.save()
         
     def _create_spirit_template(self):
         skill_names = ('Discorporate', 'Spectral Combat', 'Stealth', 'Willpower', 'Folk Magic', 'Devotion',
                        'Exhort', 'Invocation', 'Shaping', 'Binding', 'Trance')
-        for skill in self.ruleset.skills.filter(name__in=skill_names):
-            es = EnemySkill(skill=skill, enemy_template=self, die_set=skill.default_value, include=skill.include)
-            es.save()
-        es = EnemySkill.objects.get(skill__name='Stealth', enemy_template=self)
-        es.die_set = 'INT+CHA+50'
-        es.save()
-        es = EnemySkill.objects.get(skill__name='Willpower', enemy_template=self)
-        es.die_set = 'POW+POW+50'
-        es.save()
+        die_sets = {'Stealth': 'INT+CHA+50', 'Willpower': 'POW+POW+50'}
+        EnemySkill.objects.bulk_create([
+            EnemySkill(skill=skill, enemy_template=self, die_set=die_sets.get(skill.name, skill.default_value),
+                       include=skill.include)
+            for skill in self.ruleset.skills.filter(name__in=skill_names)])
         
     @property
     def get_cult_rank(self):
+        return self.cult_rank_name(self.is_theist)
+
+    def cult_rank_name(self, is_theist):
         theist_ranks = ('None', 'Lay Member', 'Initiate', 'Acolyte', 'Priest', 'High priest')
-        if self.is_theist:
+        if is_theist:
             return theist_ranks[int(self.cult_rank)]
         else:
             return self.get_cult_rank_display()
@@ -299,26 +339,77 @@ class EnemyTemplate(models.Model):
         except EnemySkill.DoesNotExist:
             return False
     
-    def generate(self, suffix=None, increment=False):
+    def generate(self, suffix=None, increment=False, rng=None):
+        """ rng is an optional random.Random instance. Generating with an equally seeded rng gives an identical
+            enemy as long as the template doesn't change.
+        """
         if increment:
             self.generated += 1
-            self.save()
+            EnemyTemplate.objects.filter(id=self.id).update(generated=F('generated') + 1)
+            Counter.add('generated', 1)
         if self.is_spirit:
-            return _Spirit(self).generate(suffix)
+            return _Spirit(self, rng).generate(suffix)
         elif self.is_elemental:
-            return _Elemental(self).generate(suffix)
+            return _Elemental(self, rng).generate(suffix)
         elif self.is_cult:
-            return _Cult(self).generate(suffix)
+            return _Cult(self, rng).generate(suffix)
         else:
-            return _Enemy(self).generate(suffix)
+            return _Enemy(self, rng).generate(suffix)
+
+    def generate_many(self, amount, increment=False, rng=None):
+        """ Generates the given amount of enemies numbered from 1 onwards.
+            With increment, the generated-count and the used-count are updated with a single query.
+        """
+        return list(self.iter_generate(amount, increment, rng))
+
+    @classmethod
+    def increment_generated(cls, index):
+        """ Updates the generated-counts and the used-counts of several templates with a single query
+            Input: a list of tuples of (EnemyTemplate, amount)
+        """
+        amounts = OrderedDict()
+        for et, amount in index:
+            amounts[et.id] = amounts.get(et.id, 0) + amount
+        if not amounts:
+            return
+        added = Case(*[When(id=et_id, then=Value(amount)) for et_id, amount in amounts.items()],
+                     output_field=models.IntegerField())
+        cls.objects.filter(id__in=amounts.keys()).update(generated=F('generated') + added, used=F('used') + 1)
+        Counter.add('generated', sum(amounts.values()))
+
+    def iter_generate(self, amount, increment=False, rng=None):
+        """ Like generate_many, but the enemies are generated one at a time as they are iterated.
+            The counts are updated immediately.
+        """
+        if increment:
+            self.generated += amount
+            self.used += 1
+            EnemyTemplate.objects.filter(id=self.id).update(generated=F('generated') + amount, used=F('used') + 1)
+            Counter.add('generated', amount)
+        return (self.generate(i+1, rng=rng) for i in range(amount))
 
     def increment_used(self):
         """ Increments the used-count by one. """
         self.used += 1
-        self.save()
+        EnemyTemplate.objects.filter(id=self.id).update(used=F('used') + 1)
+
+    def compile_plan(self):
+        """ Loads everything needed for generating enemies of this template with a fixed number of queries.
+            The GenerationPlan is kept with the template instance, so that every enemy of a batch is generated
+            in memory. Saving the template or any of its children drops the plan.
+        """
+        plan = getattr(self, '_plan', None)
+        if plan is None:
+            plan = _load_plan(self)
+            self._plan = plan
+        return plan
+
+    def forget_plan(self):
+        self._plan = None
         
     def get_tags(self):
-        return sorted(list(self.tags.names()))
+        # Iterating tags.all() uses the tags of prefetch_related('tags') when they are available
+        return sorted(tag.name for tag in self.tags.all())
     
     @property
     def stats(self):
@@ -331,6 +422,12 @@ class EnemyTemplate(models.Model):
             out[stat.name] = stat.die_set
         return out
 
+    def distribution(self, die_set):
+        """ Returns the exact Distribution of the given die set (e.g. a skill value) for enemies of this template """
+        stats = {'STR': '0', 'SIZ': '0', 'CON': '0', 'INT': '0', 'DEX': '0', 'POW': '0', 'CHA': '0'}
+        stats.update((name, value or '0') for name, value in self.stat_dict.items())
+        return distribution(die_set, stats)
+
     @property
     def skills(self):
         output = []
@@ -446,6 +543,7 @@ class EnemyTemplate(models.Model):
         EnemyNonrandomFeature.create(enemy_template=self, feature_id=feature_id)
         
     def clone(self, owner):
+        """ Copies the template and its child rows. Every child table is copied with a single bulk insert """
         name = "Copy of %s" % self.name
         new = EnemyTemplate(owner=owner, ruleset=self.ruleset, race=self.race, name=name)
         new.movement = self.movement
@@ -460,38 +558,39 @@ class EnemyTemplate(models.Model):
         new.cult_rank = self.cult_rank
         new.namelist = self.namelist
         new.natural_armor = self.natural_armor
-        new.save()
-        for tag in self.tags.all():
-            new.tags.add(tag)
-        for stat in self.stats:
-            es = EnemyStat(stat=stat.stat, enemy_template=new, die_set=stat.die_set)
-            es.save()
-        for hl in self.hit_locations:
-            EnemyHitLocation.create(hl.hit_location, enemy_template=new, armor=hl.armor)
-        for skill in self.raw_skills:
-            es = EnemySkill(skill=skill.skill, enemy_template=new, die_set=skill.die_set, include=skill.include)
-            es.save()
-        for skill in self.custom_skills:
-            es = CustomSkill(name=skill.name, enemy_template=new, die_set=skill.die_set, include=skill.include)
-            es.save()
-        for combat_style in self.combat_styles:
-            combat_style.clone(new)
-        for spell in EnemySpell.objects.filter(enemy_template=self):
-            s = EnemySpell(enemy_template=new, spell=spell.spell, probability=spell.probability, detail=spell.detail)
-            s.save()
-        for spell in CustomSpell.objects.filter(enemy_template=self):
-            s = CustomSpell(enemy_template=new, name=spell.name, probability=spell.probability, type=spell.type)
-            s.save()
-        for spirit in EnemySpirit.objects.filter(enemy_template=self):
-            es = EnemySpirit(enemy_template=new, spirit=spirit.spirit, probability=spirit.probability)
-            es.save()
-        for cult in EnemyCult.objects.filter(enemy_template=self):
-            es = EnemyCult(enemy_template=new, cult=cult.cult, probability=cult.probability)
-            es.save()
-        for af in self.additional_features:
-            EnemyAdditionalFeatureList.create(new, af.feature_list.id, af.probability)
-        for nrf in self.nonrandom_features:
-            EnemyNonrandomFeature.create(new, nrf.feature.id)
+        with transaction.atomic():
+            new.save()
+            TaggedItem.objects.bulk_create([TaggedItem(tag=tag, content_object=new) for tag in self.tags.all()])
+            EnemyStat.objects.bulk_create([EnemyStat(stat_id=stat.stat_id, enemy_template=new, die_set=stat.die_set)
+                                           for stat in EnemyStat.objects.filter(enemy_template=self)])
+            EnemyHitLocation.objects.bulk_create([
+                EnemyHitLocation(hit_location_id=hl.hit_location_id, enemy_template=new, armor=hl.armor)
+                for hl in EnemyHitLocation.objects.filter(enemy_template=self)])
+            EnemySkill.objects.bulk_create([
+                EnemySkill(skill_id=skill.skill_id, enemy_template=new, die_set=skill.die_set, include=skill.include)
+                for skill in EnemySkill.objects.filter(enemy_template=self)])
+            CustomSkill.objects.bulk_create([
+                CustomSkill(name=skill.name, enemy_template=new, die_set=skill.die_set, include=skill.include)
+                for skill in self.custom_skills])
+            CombatStyle.clone_many(self.combat_styles, new)
+            EnemySpell.objects.bulk_create([
+                EnemySpell(enemy_template=new, spell_id=spell.spell_id, probability=spell.probability, detail=spell.detail)
+                for spell in EnemySpell.objects.filter(enemy_template=self)])
+            CustomSpell.objects.bulk_create([
+                CustomSpell(enemy_template=new, name=spell.name, probability=spell.probability, type=spell.type)
+                for spell in CustomSpell.objects.filter(enemy_template=self)])
+            EnemySpirit.objects.bulk_create([
+                EnemySpirit(enemy_template=new, spirit_id=spirit.spirit_id, probability=spirit.probability)
+                for spirit in EnemySpirit.objects.filter(enemy_template=self)])
+            EnemyCult.objects.bulk_create([EnemyCult(enemy_template=new, cult_id=cult.cult_id, probability=cult.probability)
+                                           for cult in EnemyCult.objects.filter(enemy_template=self)])
+            EnemyAdditionalFeatureList.objects.bulk_create([
+                EnemyAdditionalFeatureList(enemy_template=new, feature_list_id=af.feature_list_id, probability=af.probability)
+                for af in EnemyAdditionalFeatureList.objects.filter(enemy_template=self)])
+            EnemyNonrandomFeature.objects.bulk_create([EnemyNonrandomFeature(enemy_template=new, feature_id=nrf.feature_id)
+                                                       for nrf in self.nonrandom_features])
+            # bulk_create sends no signals, so the tags are added to the search index here
+            new.update_search_index()
         return new
 
     def apply_skill_bonus(self, bonus):
@@ -506,13 +605,19 @@ class EnemyTemplate(models.Model):
 
         if bonus[0] != '+':
             bonus = '+' + bonus
-            
-        for skill in self.raw_skills:
-            skill.set_value(skill.die_set + bonus)
-        for skill in self.custom_skills:
-            skill.set_value(skill.die_set + bonus)
-        for combat_style in self.combat_styles:
-            combat_style.set_value(combat_style.die_set + bonus)
+
+        # The stored die sets are valid, so adding the validated bonus keeps them valid
+        rows = {EnemySkill: list(EnemySkill.objects.filter(enemy_template=self)),
+                CustomSkill: list(self.custom_skills),
+                CombatStyle: list(self.combat_styles)}
+        for model_rows in rows.values():
+            for row in model_rows:
+                row.die_set = clean(row.die_set + bonus)
+        with transaction.atomic():
+            for model, model_rows in rows.items():
+                model.objects.bulk_update(model_rows, ['die_set'])
+        # bulk_update sends no signals
+        self.forget_plan()
 
     def is_starred(self, user):
         if user.is_authenticated:
@@ -530,7 +635,11 @@ class EnemyTemplate(models.Model):
     def get_starred(cls, user):
         if user.is_authenticated:
             stars = Star.objects.filter(user=user).order_by('template__rank', 'template__name')
-            return [star.template for star in stars]
+            stars = stars.select_related('template__race', 'template__owner').prefetch_related('template__tags')
+            templates = [star.template for star in stars]
+            for et in templates:
+                et.starred = True
+            return templates
         else:
             return []
 
@@ -546,20 +655,26 @@ class EnemyTemplate(models.Model):
             queryset = queryset.filter(rank__in=rank_filter)
         if cult_rank_filter:
             queryset = queryset.filter(cult_rank__in=cult_rank_filter)
-        if string:
-            for word in string.split(' '):
-                if word[0] == '-':
-                    word = word[1:]
-                    queryset = queryset.exclude(name__icontains=word)
-                    queryset = queryset.exclude(race__name__icontains=word)
-                    queryset = queryset.exclude(tags__name__icontains=word)
-                else:
-                    queryset = queryset.filter(Q(name__icontains=word) | 
-                                               Q(race__name__icontains=word) |
-                                               Q(tags__name__icontains=word)
-                                               )
-        return queryset.distinct()
-        
+        for word in string.split(' '):
+            if word.startswith('-'):
+                if word[1:]:
+                    queryset = queryset.exclude(id__in=SearchTrigram.matching(word[1:]))
+            elif word:
+                queryset = queryset.filter(id__in=SearchTrigram.matching(word))
+        return queryset
+
+    def get_search_text(self):
+        """ Race, name and tags in lowercase, one per line. The race is first, so that the texts with an outdated
+            race name can be found by the race name
+        """
+        return '\n'.join([self.race.name, self.name] + self.get_tags()).lower() + '\n'
+
+    def update_search_index(self):
+        """ Updates the search text and the SearchTrigrams of the template if its name, race or tags have changed """
+        self.search_text = self.get_search_text()
+        if EnemyTemplate.objects.filter(id=self.id).exclude(search_text=self.search_text).update(search_text=self.search_text):
+            SearchTrigram.index(self)
+
     def summary_dict(self, user=None):
         """ Returns summary information about the EnemyTemplate in as a dict so that it can be jsoned """
         output = {'name': self.name, 'race': self.race.name, 'rank': self.rank, 'owner': self.owner.username,
@@ -599,7 +714,7 @@ class Party(models.Model):
     
     @property
     def template_specs(self):
-        return TemplateToParty.objects.filter(party=self).order_by('template__rank').reverse()
+        return TemplateToParty.objects.filter(party=self).order_by('template__rank', 'id').reverse().select_related('template__race')
         
     def set_published(self, published):
         if not published:
@@ -615,7 +730,7 @@ class Party(models.Model):
             raise ValidationError
             
     def get_tags(self):
-        return sorted(list(self.tags.names()))
+        return sorted(tag.name for tag in self.tags.all())
         
     def add_additional_feature(self, feature_list_id):
         PartyAdditionalFeatureList.create(party=self, feature_list_id=feature_list_id)
@@ -628,11 +743,11 @@ class Party(models.Model):
     def nonrandom_features(self):
         return PartyNonrandomFeature.objects.filter(party=self)
         
-    def get_random_additional_features(self):
+    def get_random_additional_features(self, rng=None):
         features = []
         for feature in self.additional_features:
-            if feature.random_has_feature() and len(feature.items) > 0:
-                features.append(feature.get_random_item())
+            if feature.random_has_feature(rng) and len(feature.items) > 0:
+                features.append(feature.get_random_item(rng))
         return features
 
     def add_nonrandom_feature(self, feature_id):
@@ -654,13 +769,55 @@ class Party(models.Model):
         return new
 
 
+class SearchTrigram(models.Model):
+    """ Inverted index of the trigrams in the search texts of the EnemyTemplates, used by EnemyTemplate.search """
+    template = models.ForeignKey(EnemyTemplate, on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        index_together = [('trigram', 'template'), ]
+
+    @staticmethod
+    def trigrams(text):
+        """ Returns the trigrams of each line of the text. The lines are padded with two spaces, so every substring
+            of one or two characters is the start of a trigram. Search words never contain spaces.
+        """
+        trigrams = set()
+        for line in text.split('\n'):
+            padded = line + '  '
+            trigrams.update(padded[i:i + 3] for i in range(len(line)))
+        return trigrams
+
+    @classmethod
+    def index(cls, template):
+        """ Replaces the indexed trigrams of the template with the trigrams of its search text """
+        trigrams = cls.trigrams(template.search_text)
+        indexed = set(cls.objects.filter(template=template).values_list('trigram', flat=True))
+        if indexed - trigrams:
+            cls.objects.filter(template=template, trigram__in=indexed - trigrams).delete()
+        cls.objects.bulk_create([cls(template=template, trigram=trigram) for trigram in trigrams - indexed])
+
+    @classmethod
+    def matching(cls, word):
+        """ Returns a queryset of the ids of the EnemyTemplates whose name, race name or a tag contains the word """
+        word = word.lower()
+        if len(word) < 3:
+            # A range instead of startswith, because SQLite can't use an index for LIKE
+            return cls.objects.filter(trigram__range=(word, word + '\uffff')).values('template')
+        trigrams = {word[i:i + 3] for i in range(len(word) - 2)}
+        candidates = cls.objects.filter(trigram__in=trigrams).values('template').annotate(found=models.Count('id'))
+        candidates = candidates.filter(found__gte=len(trigrams)).values('template')
+        # The trigrams may be found in different places, so the candidates are checked against the text
+        return EnemyTemplate.objects.filter(id__in=candidates, search_text__contains=word).values('id')
+
+
 class TemplateToParty(models.Model):
     template = models.ForeignKey(EnemyTemplate, on_delete=models.CASCADE)
     party = models.ForeignKey(Party, on_delete=models.CASCADE)
     amount = models.CharField(max_length=50)
     
-    def get_amount(self):
-        return Dice(self.amount).roll()
+    def get_amount(self, rng=None):
+        return Dice(self.amount).roll(rng)
 
     def __str__(self):
         return self.party.name + ' - ' + self.template.name
@@ -675,17 +832,17 @@ class CombatStyle(models.Model):
     ranged_amount = models.CharField(max_length=30, default='0')
     shield_amount = models.CharField(max_length=30, default='0')
     
-    def roll_one_h_amount(self):
-        return Dice(self.one_h_amount).roll()
+    def roll_one_h_amount(self, rng=None):
+        return Dice(self.one_h_amount).roll(rng)
     
-    def roll_two_h_amount(self):
-        return Dice(self.two_h_amount).roll()
+    def roll_two_h_amount(self, rng=None):
+        return Dice(self.two_h_amount).roll(rng)
     
-    def roll_shield_amount(self):
-        return Dice(self.shield_amount).roll()
+    def roll_shield_amount(self, rng=None):
+        return Dice(self.shield_amount).roll(rng)
     
-    def roll_ranged_amount(self):
-        return Dice(self.ranged_amount).roll()
+    def roll_ranged_amount(self, rng=None):
+        return Dice(self.ranged_amount).roll(rng)
     
     @property
     def one_h_options(self):
@@ -715,10 +872,10 @@ class CombatStyle(models.Model):
     def custom_weapons(self):
         return CustomWeapon.objects.filter(combat_style=self)
     
-    def roll(self, replace):
+    def roll(self, replace, rng=None):
         die_set = replace_die_set(self.die_set, replace)
         dice = Dice(die_set)
-        return dice.roll()
+        return dice.roll(rng)
         
     def set_one_h_amount(self, value):
         Dice(value).roll()  # Test that the value is valid
@@ -750,24 +907,32 @@ class CombatStyle(models.Model):
         return value
         
     def clone(self, et):
-        new = CombatStyle(name=self.name, die_set=self.die_set, enemy_template=et,
-                          one_h_amount=self.one_h_amount, two_h_amount=self.two_h_amount,
-                          ranged_amount=self.ranged_amount, shield_amount=self.shield_amount)
-        new.save()
-        for weapon in EnemyWeapon.objects.filter(combat_style=self):
-            EnemyWeapon.create(combat_style=new, weapon=weapon.weapon, probability=weapon.probability)
-        for weapon in CustomWeapon.objects.filter(combat_style=self):
-            cw = CustomWeapon.create(new.id, weapon.type, weapon.name, weapon.probability)
-            cw.damage = weapon.damage
-            cw.size = weapon.size
-            cw.reach = weapon.reach
-            cw.ap = weapon.ap
-            cw.hp = weapon.hp
-            cw.damage_modifier = weapon.damage_modifier
-            cw.special_effects = weapon.special_effects
-            cw.natural_weapon = weapon.natural_weapon
-            cw.ap_hp_as_per = weapon.ap_hp_as_per
-            cw.save()
+        return CombatStyle.clone_many([self], et)[0]
+
+    @classmethod
+    def clone_many(cls, combat_styles, et):
+        """ Copies the combat styles and their weapons to the EnemyTemplate with a bulk insert per table """
+        combat_styles = list(combat_styles)
+        if not combat_styles:
+            return []
+        new_styles = cls.objects.bulk_create([
+            cls(name=cs.name, die_set=cs.die_set, enemy_template=et, one_h_amount=cs.one_h_amount,
+                two_h_amount=cs.two_h_amount, ranged_amount=cs.ranged_amount, shield_amount=cs.shield_amount)
+            for cs in combat_styles])
+        if new_styles[0].pk is None:
+            # The database doesn't return the ids of bulk inserts. They are ascending in the insertion order.
+            new_styles = list(cls.objects.filter(enemy_template=et).order_by('-id')[:len(combat_styles)])[::-1]
+        copies = {cs.id: new.id for cs, new in zip(combat_styles, new_styles)}
+        EnemyWeapon.objects.bulk_create([
+            EnemyWeapon(combat_style_id=copies[weapon.combat_style_id], weapon_id=weapon.weapon_id,
+                        probability=weapon.probability)
+            for weapon in EnemyWeapon.objects.filter(combat_style__in=combat_styles)])
+        custom_weapons = list(CustomWeapon.objects.filter(combat_style__in=combat_styles))
+        for weapon in custom_weapons:
+            weapon.pk = None
+            weapon.combat_style_id = copies[weapon.combat_style_id]
+        CustomWeapon.objects.bulk_create(custom_weapons)
+        return new_styles
 
 
 class EnemyWeapon(models.Model):
@@ -913,7 +1078,7 @@ class EnemySkill(models.Model):
     def name(self):
         return self.skill.name
 
-    def roll(self, replace=None):
+    def roll(self, replace=None, rng=None):
         # Ensure, that all valid stats are present in the dict. Some races miss some stats
         # which will cause the generation to crash if the stat is nonetheless used in skills
         replace_full = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
@@ -921,7 +1086,7 @@ class EnemySkill(models.Model):
             replace_full.update(replace)
         die_set = replace_die_set(self.die_set, replace_full)
         dice = Dice(die_set)
-        return dice.roll()
+        return dice.roll(rng)
         
     def set_value(self, value):
         replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
@@ -943,10 +1108,10 @@ class CustomSkill(models.Model):
     def __str__(self):
         return self.name
 
-    def roll(self, replace=None):
+    def roll(self, replace=None, rng=None):
         die_set = replace_die_set(self.die_set, replace)
         dice = Dice(die_set)
-        return dice.roll()
+        return dice.roll(rng)
         
     def set_value(self, value):
         replace = {'STR': 0, 'SIZ': 0, 'CON': 0, 'INT': 0, 'DEX': 0, 'POW': 0, 'CHA': 0}
@@ -985,9 +1150,9 @@ class EnemyHitLocation(models.Model):
     def hp_modifier(self):
         return self.hit_location.hp_modifier
 
-    def roll(self):
+    def roll(self, rng=None):
         dice = Dice(self.armor)
-        return dice.roll()
+        return dice.roll(rng)
         
     def set_armor(self, value):
         Dice(value).roll()  # Test that the value is valid
@@ -1049,9 +1214,9 @@ class EnemyStat(models.Model):
     def name(self):
         return self.stat.name
         
-    def roll(self):
+    def roll(self, rng=None):
         dice = Dice(self.die_set)
-        return dice.roll()
+        return dice.roll(rng)
 
     def set_value(self, value):
         Dice(value).roll()  # Test that the value is valid
@@ -1203,10 +1368,9 @@ class AdditionalFeatureList(models.Model):
     def items(self):
         return AdditionalFeatureItem.objects.filter(feature_list=self)
         
-    def get_random_item(self):
-        num_items = len(self.items)
-        index = random.randint(0, num_items-1)
-        return self.items[index]
+    def get_random_item(self, rng=None):
+        items = list(self.items)
+        return _random_item(items, rng)
     
     def __unicode__(self):
         return '%s - %s' % (self.get_type_display(), self.name)
@@ -1243,14 +1407,15 @@ class EnemyAdditionalFeatureList(models.Model):
     def name(self):
         return self.feature_list.name
         
-    def get_random_item(self):
-        return self.feature_list.get_random_item()
+    def get_random_item(self, rng=None):
+        return self.feature_list.get_random_item(rng)
         
-    def random_has_feature(self, replace=None):
+    def random_has_feature(self, replace=None, rng=None):
         """ Determines randomly whether the enemy has the additional feature or not """
+        rng = rng or random
         prob = replace_die_set(self.probability, replace)
-        prob = Dice(prob).roll()
-        roll = random.randint(1, 100)
+        prob = Dice(prob).roll(rng)
+        roll = rng.randint(1, 100)
         return roll <= prob
         
     def set_probability(self, value):
@@ -1323,13 +1488,13 @@ class PartyAdditionalFeatureList(models.Model):
     def name(self):
         return self.feature_list.name
         
-    def get_random_item(self):
-        return self.feature_list.get_random_item()
+    def get_random_item(self, rng=None):
+        return self.feature_list.get_random_item(rng)
         
-    def random_has_feature(self):
+    def random_has_feature(self, rng=None):
         """ Determines randomly whether the enemy has the additional feature or not """
         prob = int(self.probability)
-        roll = random.randint(1, 100)
+        roll = (rng or random).randint(1, 100)
         return roll <= prob
         
     def set_probability(self, value):
@@ -1349,14 +1514,181 @@ class ChangeLog(models.Model):
         ordering = ['publish_date', ]
 
 
+class Counter(models.Model):
+    """ Aggregates that are maintained on every change instead of being computed from the whole table """
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    INITIAL_VALUES = {
+        'generated': lambda: EnemyTemplate.objects.aggregate(Sum('generated'))['generated__sum'] or 0,
+    }
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def get_value(cls, name):
+        """ Returns the value of the counter. A missing counter is created from its initial value """
+        counter, _ = cls.objects.get_or_create(name=name, defaults={'value': cls.INITIAL_VALUES.get(name, 0)})
+        return counter.value
+
+    @classmethod
+    def get_values(cls, *names):
+        """ Returns the values of the counters by name, with one query when they all exist """
+        values = dict(cls.objects.filter(name__in=names).values_list('name', 'value'))
+        for name in names:
+            if name not in values:
+                values[name] = cls.get_value(name)
+        return values
+
+    @classmethod
+    def add(cls, name, amount):
+        """ Counters with an initial value are created when first read, the others when first added to """
+        if not cls.objects.filter(name=name).update(value=F('value') + amount) and name not in cls.INITIAL_VALUES:
+            cls.objects.get_or_create(name=name)
+            cls.objects.filter(name=name).update(value=F('value') + amount)
+
+
+class ExportJob(models.Model):
+    """ A queued PDF rendering of a generated html file. The jobs are rendered by the render_exports command """
+    status_choices = (('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'))
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    html_file = models.CharField(max_length=200)
+    result_file = models.CharField(max_length=200, blank=True, default='')
+    status = models.CharField(max_length=10, choices=status_choices, default='queued')
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created', ]
+        index_together = [('status', 'created'), ]
+
+    def __str__(self):
+        return '%s %s' % (self.html_file, self.status)
+
+    @classmethod
+    def claim_next(cls):
+        """ Marks the oldest queued job as running and returns it. Returns None if the queue is empty.
+            The status is changed with a conditional update, so a job is claimed by only one worker.
+        """
+        for job_id in cls.objects.filter(status='queued').values_list('id', flat=True)[:10]:
+            if cls.objects.filter(id=job_id, status='queued').update(status='running', started=timezone.now()):
+                return cls.objects.get(id=job_id)
+        return None
+
+    @classmethod
+    def requeue_stale(cls, seconds):
+        """ Puts back to the queue the jobs that have been running longer than the given time,
+            e.g. because the worker was killed
+        """
+        limit = timezone.now() - datetime.timedelta(seconds=seconds)
+        return cls.objects.filter(status='running', started__lt=limit).update(status='queued', started=None)
+
+    @classmethod
+    def delete_finished(cls, seconds):
+        """ Deletes the done and failed jobs finished longer than the given time ago.
+            Returns a tuple of (deleted jobs, result files that no remaining job refers to)
+        """
+        limit = timezone.now() - datetime.timedelta(seconds=seconds)
+        old_jobs = cls.objects.filter(status__in=('done', 'failed'), finished__lt=limit)
+        result_files = set(old_jobs.exclude(result_file='').values_list('result_file', flat=True))
+        deleted, _ = old_jobs.delete()
+        result_files -= set(cls.objects.filter(result_file__in=result_files).values_list('result_file', flat=True))
+        return deleted, result_files
+
+    def finish(self, result_file=None, error=None):
+        self.status = 'failed' if error else 'done'
+        self.result_file = result_file or ''
+        self.error = error or ''
+        self.finished = timezone.now()
+        self.save(update_fields=['status', 'result_file', 'error', 'finished'])
+
+
+GenerationPlan = namedtuple('GenerationPlan', ('stats', 'skills', 'is_theist', 'folk_spells', 'theism_spells',
+                                               'sorcery_spells', 'mysticism_spells', 'hit_locations', 'combat_styles',
+                                               'additional_features', 'nonrandom_features', 'spirits', 'cults', 'names'))
+CombatStylePlan = namedtuple('CombatStylePlan', ('combat_style', 'one_h_options', 'two_h_options', 'ranged_options',
+                                                 'shield_options'))
+
+
+def _load_plan(et):
+    """ Loads the GenerationPlan of the given EnemyTemplate. Each table is queried once, regardless of the
+        amount of rows in it. The rows are always in the same order, so that seeded generation is repeatable.
+    """
+    skills = list(EnemySkill.objects.filter(enemy_template=et).select_related('skill'))
+    is_theist = et.is_cult or any(skill.include for skill in skills if skill.name == 'Devotion')
+    skills.extend(CustomSkill.objects.filter(enemy_template=et).order_by('id'))
+    skills.sort(key=lambda k: k.name)
+
+    spells = {'folk': [], 'theism': [], 'sorcery': [], 'mysticism': []}
+    for spell in EnemySpell.objects.filter(enemy_template=et).select_related('spell'):
+        spells.setdefault(spell.type, []).append(spell)
+    for spell in CustomSpell.objects.filter(enemy_template=et, probability__gt=0).order_by('name', 'id'):
+        spells.setdefault(spell.type, []).append(spell)
+
+    weapons = {}
+    for weapon in EnemyWeapon.objects.filter(combat_style__enemy_template=et).select_related('weapon').order_by('id'):
+        weapons.setdefault((weapon.combat_style_id, weapon.type), []).append(weapon)
+    for weapon in CustomWeapon.objects.filter(combat_style__enemy_template=et).order_by('id'):
+        weapons.setdefault((weapon.combat_style_id, weapon.type), []).append(weapon)
+    combat_styles = []
+    for cs in CombatStyle.objects.filter(enemy_template=et).order_by('id'):
+        options = (tuple(weapons.get((cs.id, tipe), ())) for tipe, _ in WEAPON_TYPE_CHOICES)
+        combat_styles.append(CombatStylePlan(cs, *options))
+
+    feature_lists = list(EnemyAdditionalFeatureList.objects.filter(enemy_template=et).select_related('feature_list').order_by('feature_list', 'id'))
+    list_ids = [afl.feature_list_id for afl in feature_lists]
+    if et.namelist_id:
+        list_ids.append(et.namelist_id)
+    items = {}
+    if list_ids:
+        for item in AdditionalFeatureItem.objects.filter(feature_list__in=list_ids).select_related('feature_list').order_by('name', 'id'):
+            items.setdefault(item.feature_list_id, []).append(item)
+    nonrandom_features = EnemyNonrandomFeature.objects.filter(enemy_template=et).select_related('feature__feature_list').order_by('id')
+
+    return GenerationPlan(
+        stats=tuple(EnemyStat.objects.filter(enemy_template=et).select_related('stat')),
+        skills=tuple(skills),
+        is_theist=is_theist,
+        folk_spells=tuple(spells['folk']),
+        theism_spells=tuple(spells['theism']),
+        sorcery_spells=tuple(spells['sorcery']),
+        mysticism_spells=tuple(spells['mysticism']),
+        hit_locations=tuple(EnemyHitLocation.objects.filter(enemy_template=et).select_related('hit_location')
+                            .order_by('hit_location', 'id')),
+        combat_styles=tuple(combat_styles),
+        additional_features=tuple((afl, tuple(items.get(afl.feature_list_id, ()))) for afl in feature_lists),
+        nonrandom_features=tuple(nrf.feature for nrf in nonrandom_features),
+        spirits=tuple(EnemySpirit.objects.filter(enemy_template=et, probability__gt=0).select_related('spirit__race')
+                      .order_by('spirit', 'id')),
+        cults=tuple(EnemyCult.objects.filter(enemy_template=et, probability__gt=0).select_related('cult__race')
+                    .order_by('cult', 'id')),
+        names=tuple(items.get(et.namelist_id, ())) if et.namelist_id else (),
+    )
+
+
+def _random_item(items, rng=None):
+    return items[(rng or random).randint(0, len(items)-1)]
+
+
+def _copy_enemy_weapon(enemy_weapon):
+    enemy_weapon = copy.copy(enemy_weapon)
+    enemy_weapon.weapon = copy.copy(enemy_weapon.weapon)
+    return enemy_weapon
+
+
 class _Enemy(object):
     """ Enemy instance created based on an EnemyTemplate. This is the stuff that gets printed
         for the user when Generate is clicked.
     """
-    def __init__(self, enemy_template):
+    def __init__(self, enemy_template, rng=None):
         self.name = ''
         self.et = enemy_template
-        self.cult_rank = self.et.get_cult_rank
+        self.rng = rng or random
+        self.plan = None
+        self.cult_rank = None
         self.stats = OrderedDict()
         self.stats_list = []
         self.skills = []
@@ -1380,6 +1712,7 @@ class _Enemy(object):
         self.is_spirit = self.et.is_spirit
 
     def generate(self, suffix=None):
+        self._load_plan()
         self._generate_name(suffix)
         self._add_stats()
         self._add_skills()
@@ -1394,6 +1727,10 @@ class _Enemy(object):
         self._add_combat_styles()
         self.natural_armor = self.et.natural_armor
         return self
+
+    def _load_plan(self):
+        self.plan = self.et.compile_plan()
+        self.cult_rank = self.et.cult_rank_name(self.plan.is_theist)
         
     @property
     def get_stats(self):
@@ -1403,38 +1740,40 @@ class _Enemy(object):
         self.name = self.et.name
         if suffix:
             self.name += ' %s' % suffix
-        if self.et.namelist:
-            self.name = '%s (%s)' % (self.et.namelist.get_random_item().name, self.name)
+        if self.plan.names:
+            self.name = '%s (%s)' % (_random_item(self.plan.names, self.rng).name, self.name)
         
     def _add_stats(self):
-        for stat in self.et.stats:
-            self.stats[stat.name] = stat.roll()
+        for stat in self.plan.stats:
+            self.stats[stat.name] = stat.roll(self.rng)
             self.stats_list.append({'name': stat.name, 'value': self.stats[stat.name]})
     
     def _add_skills(self):
-        for skill in self.et.skills:
+        for skill in self.plan.skills:
             if skill.include:
-                value = skill.roll(self.stats)
+                value = skill.roll(self.stats, self.rng)
                 self.skills.append({'name': skill.name, 'value': value})
                 self.skills_dict[skill.name] = value
     
     def _add_combat_styles(self):
-        for cs in self.et.combat_styles:
-            combat_style = {'value': cs.roll(self.stats), 'name': cs.name, 'weapons': self._add_weapons(cs)}
+        for cs_plan in self.plan.combat_styles:
+            cs = cs_plan.combat_style
+            combat_style = {'value': cs.roll(self.stats, self.rng), 'name': cs.name, 'weapons': self._add_weapons(cs_plan)}
             self.combat_styles.append(combat_style)
             
-    def _add_weapons(self, cs):
-        """ Returns a list of weapons based on the given CombatStyle's weapon selections and probabilities
+    def _add_weapons(self, cs_plan):
+        """ Returns a list of weapons based on the given CombatStylePlan's weapon selections and probabilities
         """
         output = []
-        one_h_amount = min(cs.roll_one_h_amount(), len(cs.one_h_options))
-        two_h_amount = min(cs.roll_two_h_amount(), len(cs.two_h_options))
-        ranged_amount = min(cs.roll_ranged_amount(), len(cs.ranged_options))
-        shield_amount = min(cs.roll_shield_amount(), len(cs.shield_options))
-        output.extend(select_random_items(cs.one_h_options, one_h_amount))
-        output.extend(select_random_items(cs.two_h_options, two_h_amount))
-        output.extend(select_random_items(cs.ranged_options, ranged_amount))
-        output.extend(select_random_items(cs.shield_options, shield_amount))
+        cs = cs_plan.combat_style
+        one_h_amount = min(cs.roll_one_h_amount(self.rng), len(cs_plan.one_h_options))
+        two_h_amount = min(cs.roll_two_h_amount(self.rng), len(cs_plan.two_h_options))
+        ranged_amount = min(cs.roll_ranged_amount(self.rng), len(cs_plan.ranged_options))
+        shield_amount = min(cs.roll_shield_amount(self.rng), len(cs_plan.shield_options))
+        output.extend(select_random_items(cs_plan.one_h_options, one_h_amount, self.rng))
+        output.extend(select_random_items(cs_plan.two_h_options, two_h_amount, self.rng))
+        output.extend(select_random_items(cs_plan.ranged_options, ranged_amount, self.rng))
+        output.extend(select_random_items(cs_plan.shield_options, shield_amount, self.rng))
         output = self._adjust_size_and_reach(output)
         return output
         
@@ -1445,6 +1784,8 @@ class _Enemy(object):
             return weapons
         sizes = [value for value, _ in WEAPON_SIZE_CHOICES]
         reaches = [value for value, _ in WEAPON_REACH_CHOICES]
+        # The weapons are shared by all the enemies generated from the same plan, so adjust copies of them
+        weapons = [_copy_enemy_weapon(item) if isinstance(item, EnemyWeapon) else item for item in weapons]
         for item in weapons:
             if item.__class__.__name__ == 'EnemyWeapon':
                 index = sizes.index(item.weapon.size) + step
@@ -1469,42 +1810,42 @@ class _Enemy(object):
     def _add_hit_locations(self):
         con_siz = self.stats['CON'] + self.stats['SIZ']
         base_hp = ((con_siz-1) // 5) + 1  # used by Head and Legs
-        for hl in self.et.hit_locations:
-            hp = max(base_hp + Dice(hl.hp_modifier).roll(), 1)
-            ap = hl.roll()
+        for hl in self.plan.hit_locations:
+            hp = max(base_hp + Dice(hl.hp_modifier).roll(self.rng), 1)
+            ap = hl.roll(self.rng)
             enemy_hl = {'name': hl.name, 'range': hl.range, 'hp': hp, 'ap': ap, 'parent': hl}
             self.hit_locations.append(enemy_hl)
         
     def _add_spells(self):
-        amount = min(Dice(self.et.folk_spell_amount).roll(), len(self.et.folk_spells))
-        self.folk_spells = sorted(select_random_items(self.et.folk_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.theism_spell_amount).roll(), len(self.et.theism_spells))
-        self.theism_spells = sorted(select_random_items(self.et.theism_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.sorcery_spell_amount).roll(), len(self.et.sorcery_spells))
-        self.sorcery_spells = sorted(select_random_items(self.et.sorcery_spells, amount), key=lambda s: s.name)
-        amount = min(Dice(self.et.mysticism_spell_amount).roll(), len(self.et.mysticism_spells))
-        self.mysticism_spells = sorted(select_random_items(self.et.mysticism_spells, amount), key=lambda s: s.name)
+        amount = min(Dice(self.et.folk_spell_amount).roll(self.rng), len(self.plan.folk_spells))
+        self.folk_spells = sorted(select_random_items(self.plan.folk_spells, amount, self.rng), key=lambda s: s.name)
+        amount = min(Dice(self.et.theism_spell_amount).roll(self.rng), len(self.plan.theism_spells))
+        self.theism_spells = sorted(select_random_items(self.plan.theism_spells, amount, self.rng), key=lambda s: s.name)
+        amount = min(Dice(self.et.sorcery_spell_amount).roll(self.rng), len(self.plan.sorcery_spells))
+        self.sorcery_spells = sorted(select_random_items(self.plan.sorcery_spells, amount, self.rng), key=lambda s: s.name)
+        amount = min(Dice(self.et.mysticism_spell_amount).roll(self.rng), len(self.plan.mysticism_spells))
+        self.mysticism_spells = sorted(select_random_items(self.plan.mysticism_spells, amount, self.rng), key=lambda s: s.name)
         
     def _add_spirits(self):
-        spirit_options = self.et.spirits.filter(probability__gt=0).exclude(spirit__race__name='Cult')
-        amount = min(Dice(self.et.spirit_amount).roll(), len(spirit_options))
-        spirit_templates = select_random_items(spirit_options, amount)
+        spirit_options = [es for es in self.plan.spirits if es.spirit.race.name != 'Cult']
+        amount = min(Dice(self.et.spirit_amount).roll(self.rng), len(spirit_options))
+        spirit_templates = select_random_items(spirit_options, amount, self.rng)
         retries = 5
         for st in spirit_templates:
             i = 0
             spirit = None
             while spirit is None or (spirit.stats['POW'] > self.attributes['max_pow'] and i < retries):
                 i += 1
-                spirit = st.spirit.generate()
+                spirit = st.spirit.generate(rng=self.rng)
             if spirit.stats['POW'] <= self.attributes['max_pow']:
                 self.spirits.append(spirit)
         
     def _add_cults(self):
-        amount = min(Dice(self.et.cult_amount).roll(), len(self.et.cults.filter(probability__gt=0)))
-        cult_templates = select_random_items(self.et.cults.filter(probability__gt=0), amount)
+        amount = min(Dice(self.et.cult_amount).roll(self.rng), len(self.plan.cults))
+        cult_templates = select_random_items(self.plan.cults, amount, self.rng)
         for ct in cult_templates:
             self.cult = ct.cult
-            cult = ct.cult.generate()
+            cult = ct.cult.generate(rng=self.rng)
             self.folk_spells += cult.folk_spells
             self.theism_spells += cult.theism_spells
             self.sorcery_spells += cult.sorcery_spells
@@ -1528,12 +1869,11 @@ class _Enemy(object):
         self.spirits.sort(key=lambda item: item.name)
         
     def _add_additional_features(self):
-        for feature_list in self.et.additional_features:
-            if feature_list.random_has_feature(self.stats) and len(feature_list.items) > 0:
-                feature = feature_list.get_random_item()
+        for feature_list, items in self.plan.additional_features:
+            if feature_list.random_has_feature(self.stats, self.rng) and len(items) > 0:
+                feature = _random_item(items, self.rng)
                 self.additional_features.append(feature)
-        for feature in self.et.nonrandom_features:
-            fture = feature.feature
+        for fture in self.plan.nonrandom_features:
             # Used in the html template to show the non-random features only once if there's only one type of enemies
             fture.non_random = True
             self.additional_features.append(fture)
@@ -1609,26 +1949,28 @@ class _Enemy(object):
 
 
 class _Cult(_Enemy):
-    def __init__(self, enemy_template):
-        super(_Cult, self).__init__(enemy_template)
+    def __init__(self, enemy_template, rng=None):
+        super(_Cult, self).__init__(enemy_template, rng)
         
     def generate(self, suffix=None):
+        self._load_plan()
         self._generate_name(suffix)
         self._add_spells()
         self._add_spirits()
         return self
         
     def _add_spirits(self):
-        amount = min(Dice(self.et.spirit_amount).roll(), len(self.et.spirits.filter(probability__gt=0)))
-        spirit_templates = select_random_items(self.et.spirits.filter(probability__gt=0), amount)
+        amount = min(Dice(self.et.spirit_amount).roll(self.rng), len(self.plan.spirits))
+        spirit_templates = select_random_items(self.plan.spirits, amount, self.rng)
         for st in spirit_templates:
-            spirit = st.spirit.generate()
+            spirit = st.spirit.generate(rng=self.rng)
             self.spirits.append(spirit)
 
 
 class _Spirit(_Enemy):
     """ Spirit type of Enemy """
     def generate(self, suffix=None):
+        self._load_plan()
         self._generate_name(suffix)
         self._add_stats()
         self._add_skills()
@@ -1642,8 +1984,8 @@ class _Spirit(_Enemy):
         return self
 
     def _add_stats(self):
-        for stat in self.et.stats:
-            self.stats[stat.name] = stat.roll()
+        for stat in self.plan.stats:
+            self.stats[stat.name] = stat.roll(self.rng)
             self.stats_list.append({'name': stat.name, 'value': self.stats[stat.name]})
         self.stats['CON'] = self.stats['POW']
         self.stats['STR'] = self.stats['POW']
@@ -1703,6 +2045,7 @@ class _Elemental(_Enemy):
     """ Elemental type of enemy """
 
     def generate(self, suffix=None):
+        self._load_plan()
         self._generate_name(suffix)
         self._add_stats()
         self.stats['SIZ'] = self.stats['STR']
@@ -1724,14 +2067,14 @@ class _Elemental(_Enemy):
         # hit poits, so I'm calculating them based on POW.
         # If POW is 1d6+6, HP is 1d6+12. So both of them have 1d6 always, and the additional
         # part is double for hit points.
-        power = next((stat.die_set for stat in self.et.stats if stat.name == 'POW'), '')
+        power = next((stat.die_set for stat in self.plan.stats if stat.name == 'POW'), '')
         try:
             modifier = 2 * int(power.split('+')[1])
         except (IndexError, TypeError):
             modifier = 0
-        for hl in self.et.hit_locations:
-            hp = max(Dice('1d6').roll() + modifier, 1)
-            ap = hl.roll()
+        for hl in self.plan.hit_locations:
+            hp = max(Dice('1d6').roll(self.rng) + modifier, 1)
+            ap = hl.roll(self.rng)
             enemy_hl = {'name': hl.name, 'range': hl.range, 'hp': hp, 'ap': ap, 'parent': hl}
             self.hit_locations.append(enemy_hl)
 
@@ -1757,3 +2100,102 @@ class Star(models.Model):
     
 def _divide_round_up(n, d):
     return (n + (d - 1)) // d
+
+
+def _forget_template_plan(sender, instance, **kwargs):
+    """ Drops the generation plan of the loaded EnemyTemplate, that the saved or deleted child object belongs to """
+    if isinstance(instance, (EnemyWeapon, CustomWeapon)):
+        if not sender.combat_style.is_cached(instance):
+            return
+        instance = instance.combat_style
+    if type(instance).enemy_template.is_cached(instance):
+        instance.enemy_template.forget_plan()
+
+
+for _model in (EnemyStat, EnemySkill, CustomSkill, EnemySpell, CustomSpell, EnemyHitLocation, CombatStyle,
+               EnemyWeapon, CustomWeapon, EnemySpirit, EnemyCult, EnemyAdditionalFeatureList, EnemyNonrandomFeature):
+    post_save.connect(_forget_template_plan, sender=_model)
+    post_delete.connect(_forget_template_plan, sender=_model)
+
+
+SIDEBAR_CACHE_KEY = 'enemygen_sidebar'
+SIDEBAR_VERSION = 'sidebar_version'
+
+
+def forget_sidebar_data(**kwargs):
+    """ Drops the cached tag lists and changelog date shown on every page. The cache key contains the shared
+        sidebar version, so a per-process cache is renewed in every worker process too
+    """
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and set(update_fields) <= {'generated', 'used'}:
+        return
+    Counter.add(SIDEBAR_VERSION, 1)
+
+
+def _subtract_generated(sender, instance, **kwargs):
+    Counter.add('generated', -instance.generated)
+
+
+for _model in (Tag, TaggedItem, ChangeLog, EnemyTemplate, Party):
+    post_save.connect(forget_sidebar_data, sender=_model)
+    post_delete.connect(forget_sidebar_data, sender=_model)
+post_delete.connect(_subtract_generated, sender=EnemyTemplate)
+
+
+CATALOG_VERSION = 'catalog_version'
+
+
+def bump_catalog_version(sender=None, **kwargs):
+    """ Marks the template and party listings changed, so their cached json and ETags are renewed """
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and set(update_fields) <= {'generated', 'used'}:
+        return
+    Counter.add(CATALOG_VERSION, 1)
+
+
+for _model in (EnemyTemplate, Party, TemplateToParty, Race, Tag, TaggedItem, Star):
+    post_save.connect(bump_catalog_version, sender=_model)
+    post_delete.connect(bump_catalog_version, sender=_model)
+
+
+def _update_search_index(sender, instance, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if kwargs.get('raw') or (update_fields is not None and set(update_fields) <= {'generated', 'used'}):
+        return
+    instance.update_search_index()
+
+
+def _update_tags_search_index(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, EnemyTemplate):
+        getattr(instance, '_prefetched_objects_cache', {}).pop('tags', None)
+        instance.update_search_index()
+
+
+def _remember_tagged_templates(sender, instance, **kwargs):
+    instance.tagged_template_ids = list(EnemyTemplate.objects.filter(tags=instance).values_list('id', flat=True))
+
+
+def _reindex_tagged_templates(sender, instance, **kwargs):
+    """ Renamed and deleted tags change the search texts of the templates that were tagged with them """
+    if kwargs.get('raw'):
+        return
+    ids = getattr(instance, 'tagged_template_ids', None)
+    templates = EnemyTemplate.objects.filter(id__in=ids) if ids is not None else EnemyTemplate.objects.filter(tags=instance)
+    for et in templates.select_related('race').prefetch_related('tags'):
+        et.update_search_index()
+
+
+def _reindex_race_templates(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    templates = EnemyTemplate.objects.filter(race=instance).exclude(search_text__startswith=instance.name.lower() + '\n')
+    for et in templates.select_related('race').prefetch_related('tags'):
+        et.update_search_index()
+
+
+post_save.connect(_update_search_index, sender=EnemyTemplate)
+m2m_changed.connect(_update_tags_search_index, sender=TaggedItem)
+post_save.connect(_reindex_tagged_templates, sender=Tag)
+pre_delete.connect(_remember_tagged_templates, sender=Tag)
+post_delete.connect(_reindex_tagged_templates, sender=Tag)
+post_save.connect(_reindex_race_templates, sender=Race)
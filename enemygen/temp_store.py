@@ -0,0 +1,79 @@
+""" Storage of the generated files under settings.TEMP: the html sheets of generated enemies and their exports.
+    The files are spread to 256 shard directories by the hash of the file name, so no directory grows too big.
+    The modification time of a file is its last use, files are touched when they are used.
+    sweep() deletes expired files and the least recently used files over the size quota.
+"""
+from django.conf import settings
+
+import hashlib
+import os
+import time
+
+KEEP = ('statistics.json', )
+PARTIAL_PREFIXES = ('partial_', 'statistics_')  # Files that are being written and renamed when ready
+PARTIAL_MAX_AGE = 3600  # seconds
+
+
+def path(file_name, area=''):
+    """ Returns the sharded path of the given file name, e.g. TEMP/area/3f/file_name """
+    shard = hashlib.md5(file_name.encode('utf-8')).hexdigest()[:2]
+    return os.path.join(settings.TEMP, area, shard, file_name)
+
+
+def find(file_name):
+    """ Returns the path of the given file and marks it as used. Files saved directly under TEMP before
+        sharding are found too. Returns None if the file doesn't exist.
+    """
+    for file_path in (path(file_name), os.path.join(settings.TEMP, file_name)):
+        if touch(file_path):
+            return file_path
+    return None
+
+
+def touch(file_path):
+    """ Marks the file as used. Returns False if the file doesn't exist """
+    try:
+        os.utime(file_path)
+        return True
+    except OSError:
+        return False
+
+
+def sweep(ttl=None, max_bytes=None, area=''):
+    """ Deletes the files not used within ttl seconds, and then the least recently used files until the
+        files take at most max_bytes. The defaults are settings.TEMP_TTL and settings.TEMP_MAX_BYTES.
+        Returns a tuple of (deleted files, bytes reclaimed)
+    """
+    if ttl is None:
+        ttl = getattr(settings, 'TEMP_TTL', 7 * 24 * 3600)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'TEMP_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+    now = time.time()
+    temp_root = os.path.normpath(settings.TEMP)
+    files = []
+    for root, _, names in os.walk(os.path.normpath(os.path.join(temp_root, area))):
+        for name in names:
+            if name in KEEP and root == temp_root:
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if name.startswith(PARTIAL_PREFIXES) and now - stat.st_mtime < PARTIAL_MAX_AGE:
+                continue
+            files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    reclaimed = 0
+    for mtime, size, file_path in files:
+        if total <= max_bytes and now - mtime <= ttl:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            continue
+        total -= size
+        deleted += 1
+        reclaimed += size
+    return deleted, reclaimed
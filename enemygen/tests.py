@@ -6,21 +6,45 @@ Replace this with more appropriate tests for your application.
 """
 from django.test import TestCase
 from django.test import RequestFactory, SimpleTestCase
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
 from django.http import HttpResponse
+from django.db import connection
+from django.db.models import Sum
+from django.core.cache import cache
+from django.core.management import call_command
+from django.conf import settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from taggit.models import Tag
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+import datetime
 import json
+import random
+import tempfile
+import shutil
+import os
+import io
+import time
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 from mythras_eg.middleware import SimpleCorsMiddleware
 
-from .dice import Dice, _die_to_tuple, clean
+from .dice import Dice, _die_to_tuple, clean, cache_info, clear_cache, distribution
+from . import dice
 
-from .models import EnemyTemplate, _Enemy, Ruleset, StatAbstract, Race, SpellAbstract
-from .models import EnemyStat, EnemySkill, SkillAbstract, EnemySpell
-from .models import CombatStyle, Weapon
-from .enemygen_lib import select_random_item, replace_die_set
-from .views_lib import as_json
+from .models import EnemyTemplate, _Enemy, Ruleset, StatAbstract, Race, SpellAbstract, HitLocation
+from .models import EnemyStat, EnemySkill, SkillAbstract, EnemySpell, CustomSkill, EnemyWeapon, CustomWeapon
+from .models import CombatStyle, Weapon, Star, Counter, ExportJob, Party, TemplateToParty, SearchTrigram
+from .enemygen_lib import select_random_item, select_random_items, replace_die_set, WeightedSampler, ValidationError
+from .views_lib import as_json, get_enemy_templates, get_context, get_statistics, generate_pngs, generate_pdf
+from .views_lib import evict_export_cache, save_encounter_html, get_html_path, read_sheet
+from . import views_lib
+from . import temp_store
+from . import views
+from . import ajax
+from .management.commands import render_exports
 
 class TestDice(TestCase):
     def test_1_die_to_tuple(self):
@@ -82,6 +106,12 @@ class TestDice(TestCase):
         self.assertEquals(Dice('5D100-D100').max_roll(), 499)
         self.assertEquals(Dice('12D6').max_roll(), 72)
 
+    def test_4_min_roll(self):
+        self.assertEquals(Dice('5').min_roll(), 5)
+        self.assertEquals(Dice('5D100+13').min_roll(), 18)
+        self.assertEquals(Dice('5D100-D100').min_roll(), -95)
+        self.assertEquals(Dice('20-2D4').min_roll(), 12)
+
 
     def test_5_clean(self):
         self.assertEqual(clean('D6'), '1d6')
@@ -101,6 +131,62 @@ class TestDice(TestCase):
         self.assertEqual(clean('DEX+10+d10-5-5'), 'DEX+1d10')
         self.assertEqual(clean('STR+DEX+20+5D10+-4D10+2D10+-4D10+2D10'), 'STR+DEX+1d10+20')
 
+    def test_6_parse_cache(self):
+        clear_cache()
+        Dice('2D6+6')
+        Dice('2d6+6')  # Dice sets are upper cased before parsing, so this is the same expression
+        dice = Dice('2D6+6')
+        self.assertEqual(dice.components, ((1, 6, 2), 6))
+        info = cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+        self.assertRaises(ValueError, Dice, 'invalid')
+
+    def test_7_roll_many(self):
+        rolls = Dice('20-2D4').roll_many(200)
+        self.assertEqual(len(rolls), 200)
+        self.assertTrue(all(12 <= r <= 18 for r in rolls))
+        self.assertEqual(len(Dice('5').roll_many(0)), 0)
+        self.assertEqual(list(Dice('5').roll_many(3)), [5, 5, 5])
+        # Same seed gives the same rolls
+        self.assertEqual(list(Dice('3D6+2D10').roll_many(50, random.Random(1))),
+                         list(Dice('3D6+2D10').roll_many(50, random.Random(1))))
+
+    def test_8_roll_many_without_numpy(self):
+        numpy = dice.numpy
+        dice.numpy = None
+        try:
+            rolls = Dice('6+D6').roll_many(100, random.Random(1))
+        finally:
+            dice.numpy = numpy
+        self.assertTrue(isinstance(rolls, list))
+        self.assertTrue(all(7 <= r <= 12 for r in rolls))
+
+    def test_9_distribution(self):
+        dist = Dice('2D6+6').distribution()
+        self.assertEqual(dist.min, 8)
+        self.assertEqual(dist.max, 18)
+        self.assertAlmostEqual(dist.pmf[13], 6 / 36)
+        self.assertAlmostEqual(sum(dist.pmf.values()), 1)
+        self.assertAlmostEqual(dist.mean, 13)
+        self.assertAlmostEqual(dist.variance, 35 / 6)
+        self.assertEqual(dist.percentile(50), 13)
+        self.assertEqual(dist.percentile(100), 18)
+        self.assertEqual(Dice('20-2D4').distribution().min, 12)
+        self.assertEqual(Dice('5').distribution().pmf, {5: 1})
+        self.assertTrue(Dice('2d6+6').distribution() is dist)  # Memoized per expression
+
+    def test_10_distribution_with_stats(self):
+        dist = distribution('STR+DEX+1d10', {'STR': '3d6', 'DEX': '2d6+6'})
+        self.assertEqual(dist.min, 3 + 8 + 1)
+        self.assertEqual(dist.max, 18 + 18 + 10)
+        self.assertAlmostEqual(dist.mean, 10.5 + 13 + 5.5)
+        # The same stat is not rolled twice
+        dist = distribution('POW+POW', {'POW': '1d6'})
+        self.assertEqual(sorted(dist.pmf), [2, 4, 6, 8, 10, 12])
+        dist = distribution('50-DEX', {'DEX': '1d6'})
+        self.assertEqual((dist.min, dist.max), (44, 49))
+
 
 class TestEnemyTemplate(TestCase):
     fixtures = ('enemygen_testdata.json',)
@@ -122,6 +208,12 @@ class TestEnemyTemplate(TestCase):
         self.assertEquals(et.skills[0].die_set, 'STR+DEX')
         self.assertTrue(et.combat_styles[0].name, "Primary Combat Style")
 
+    def test_02_distribution(self):
+        et = get_enemy_template()
+        dist = et.distribution('STR+DEX+10')
+        self.assertEqual((dist.min, dist.max), (16, 46))
+        self.assertAlmostEqual(dist.mean, 31)
+
     def test_12_generate(self):
         et = get_enemy_template()
         enemy = et.generate()
@@ -196,6 +288,132 @@ class TestEnemyTemplate(TestCase):
         sr = '%s(%s-0)' % (sr, sr)
         self.assertEquals(enemy.attributes['strike_rank'], sr)
         
+    def test_16_generation_plan(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        plan = et.compile_plan()
+        self.assertTrue(et.compile_plan() is plan)
+        self.assertEqual([spell.name for spell in plan.folk_spells], ['Bladesharp', 'Calm'])
+        et.generate()
+        with self.assertNumQueries(0):
+            for i in range(10):
+                et.generate(i + 1)
+        # Saving a child of the template drops the plan
+        EnemySpell(enemy_template=et, spell=SpellAbstract.objects.get(name='Alarm'), probability=1).save()
+        self.assertEqual(len(et.compile_plan().folk_spells), 3)
+        et.save()
+        self.assertFalse(et.compile_plan() is plan)
+
+    def test_17_generation_plan_query_count(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        with CaptureQueriesContext(connection) as one_enemy:
+            EnemyTemplate.objects.get(id=et.id).generate(1)
+        with CaptureQueriesContext(connection) as many_enemies:
+            et = EnemyTemplate.objects.get(id=et.id)
+            for i in range(20):
+                et.generate(i + 1)
+        self.assertEqual(len(one_enemy), len(many_enemies))
+
+    def test_18_generate_many(self):
+        et = get_enemy_template()
+        enemies = et.generate_many(5, increment=True)
+        self.assertEqual([enemy.name for enemy in enemies], ['Test Template %s' % i for i in range(1, 6)])
+        et = EnemyTemplate.objects.get(id=et.id)
+        self.assertEqual((et.generated, et.used), (5, 1))
+        et.generate_many(3)
+        et.refresh_from_db()
+        self.assertEqual((et.generated, et.used), (5, 1))
+
+    def test_19_seeded_generation(self):
+        et = get_enemy_template()
+        _add_magic(et)
+        et.save()
+        first = as_json(et.generate_many(5, rng=random.Random(42)))
+        second = as_json(EnemyTemplate.objects.get(id=et.id).generate_many(5, rng=random.Random(42)))
+        self.assertEqual(first, second)
+
+    def _rows(self, et):
+        return (sorted((s.name, s.die_set) for s in et.stats), sorted((s.name, s.die_set, s.include) for s in et.skills),
+                sorted((hl.name, hl.armor) for hl in et.hit_locations), et.get_tags(),
+                sorted((s.spell.name, s.probability) for s in EnemySpell.objects.filter(enemy_template=et)),
+                sorted((cs.name, cs.die_set, sorted((w.name, w.probability) for w in EnemyWeapon.objects.filter(combat_style=cs)),
+                        sorted((w.name, w.damage, w.range) for w in CustomWeapon.objects.filter(combat_style=cs)))
+                       for cs in et.combat_styles))
+
+    def _clone_queries(self, et, user):
+        with CaptureQueriesContext(connection) as queries:
+            new = et.clone(user)
+        self.assertEqual(self._rows(new), self._rows(et))
+        self.assertEqual(new.name, 'Copy of %s' % et.name)
+        return len(queries)
+
+    def _add_rows(self, et, amount):
+        """ Adds amount tags, custom skills and combat styles with amount weapons each """
+        for i in range(amount):
+            et.tags.add('tag%s' % i)
+            CustomSkill(name='Juggling %s' % i, enemy_template=et, die_set='DEX+DEX', include=True).save()
+            cs = CombatStyle(name='Style %s' % i, enemy_template=et, die_set='STR+DEX')
+            cs.save()
+            for weapon in Weapon.objects.all()[:amount]:
+                EnemyWeapon.create(combat_style=cs, weapon=weapon, probability=2)
+            cw = CustomWeapon.create(cs.id, 'ranged', 'Sling %s' % i)
+            cw.range = '10/20/30'
+            cw.save()
+
+    def test_20_clone_query_count(self):
+        et = get_enemy_template()
+        user = User.objects.get(username='username')
+        _add_magic(et)
+        et.save()
+        self._add_rows(et, 1)
+        few_queries = self._clone_queries(et, user)
+        self._add_rows(et, 4)
+        self.assertEqual(self._clone_queries(et, user), few_queries)
+        self.assertEqual(len([et for et in EnemyTemplate.search('copy tag3', user)]), 1)
+
+    def _create_queries(self, user, race):
+        with CaptureQueriesContext(connection) as queries:
+            et = EnemyTemplate.create(user, Ruleset.objects.get(id=1), race)
+        self.assertEqual(et.name, '%s Template %s' % (race.name, et.id))
+        return et, len(queries)
+
+    def test_21_create_query_count(self):
+        user = User(username='username')
+        user.save()
+        race = Race.create(user, 'Many-legged')
+        self.assertEqual(len(race.hit_locations), 7)
+        self.assertEqual(len(race.stats), StatAbstract.objects.count())
+        et, few_queries = self._create_queries(user, race)
+        self.assertEqual(len(et.hit_locations), 7)
+        self.assertEqual(len(et.stats), StatAbstract.objects.count())
+        for i in range(5):
+            HitLocation(name='Leg %s' % i, range_start=1, range_end=1, race=race).save()
+        et, many_queries = self._create_queries(user, race)
+        self.assertEqual(len(et.hit_locations), 12)
+        self.assertEqual(few_queries, many_queries)
+        race.discorporate = True
+        race.save()
+        et, _ = self._create_queries(user, race)
+        self.assertEqual(len(et.hit_locations), 0)
+        self.assertEqual(EnemySkill.objects.get(enemy_template=et, skill__name='Willpower').die_set, 'POW+POW+50')
+        self.assertEqual(EnemySkill.objects.get(enemy_template=et, skill__name='Binding').die_set,
+                         SkillAbstract.objects.get(name='Binding').default_value)
+
+    def test_22_apply_skill_bonus(self):
+        et = get_enemy_template()
+        CustomSkill(name='Juggling', enemy_template=et, die_set='DEX+DEX', include=True).save()
+        before = {skill.name: skill.die_set for skill in et.skills}
+        with CaptureQueriesContext(connection) as queries:
+            et.apply_skill_bonus('1d4')
+        self.assertLessEqual(len(queries), 8)
+        after = {skill.name: skill.die_set for skill in et.skills}
+        self.assertEqual(after, {name: clean(die_set + '+1D4') for name, die_set in before.items()})
+        self.assertEqual(after['Juggling'], 'DEX+DEX+1d4')
+        self.assertEqual(et.combat_styles[0].die_set, clean(CombatStyle().die_set + '+1d4'))
+        self.assertRaises(ValueError, et.apply_skill_bonus, '+x5')
+        self.assertEqual({skill.name: skill.die_set for skill in et.skills}, after)
+
     def notest_16_generate_check_weapon_styles(self):
         # Fix this test!!!!!!!!!!!!!!!
         et = get_enemy_template()
@@ -335,6 +553,38 @@ class TestEnemySkill(TestCase):
         self.assertRaises(ValueError, es.set_value, 'invalid')
 
 
+class TestRaceChanges(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        self.user = User(username='username')
+        self.user.save()
+        self.race = Race.create(self.user, 'Propagated')
+        self.templates = [EnemyTemplate.create(self.user, Ruleset.objects.get(id=1), self.race) for _ in range(3)]
+
+    def test_add_hit_location(self):
+        hl, changed = self.race.add_hit_location()
+        self.assertEqual(changed, 3)
+        self.assertEqual((hl.range_start, hl.range_end), (20, 20))
+        for et in self.templates:
+            self.assertEqual([ehl.name for ehl in et.hit_locations].count('New hit location'), 1)
+            self.assertEqual(len(et.hit_locations), 8)
+
+    def test_apply_notes_to_templates(self):
+        other = User(username='other')
+        other.save()
+        EnemyTemplate.create(other, Ruleset.objects.get(id=1), self.race)
+        EnemyTemplate.objects.filter(id=self.templates[0].id).update(notes=None)
+        EnemyTemplate.objects.filter(id=self.templates[1].id).update(notes='Has wings.')
+        version = Counter.get_value('catalog_version')
+        self.assertEqual(self.race.apply_notes_to_templates('Has wings.', self.user), 2)
+        self.assertEqual(Counter.get_value('catalog_version'), version + 1)
+        self.assertEqual(self.race.apply_notes_to_templates('Has wings.', self.user), 0)
+        notes = [EnemyTemplate.objects.get(id=et.id).notes for et in self.templates]
+        self.assertEqual(notes, ['\nHas wings.', 'Has wings.', '%s\nHas wings.' % self.templates[2].notes])
+        self.assertFalse(EnemyTemplate.objects.filter(owner=other, notes__contains='wings').exists())
+
+
 class TestMisc(TestCase):
     fixtures = ('enemygen_testdata.json',)
     
@@ -366,6 +616,40 @@ class TestMisc(TestCase):
         self.assertEquals(random_spell, spells[2])
 
 
+Item = namedtuple('Item', 'name probability')
+
+
+class TestSampling(SimpleTestCase):
+    def setUp(self):
+        self.items = [Item('item%03d' % i, i % 5) for i in range(100)]
+
+    def test_select_random_items(self):
+        rng = random.Random(1)
+        for amount in (0, 1, 10, 80):
+            selected = select_random_items(self.items, amount, rng)
+            self.assertEqual(len(set(selected)), amount)
+            self.assertEqual(selected, sorted(selected, key=lambda item: item.name))
+            self.assertTrue(all(item.probability > 0 for item in selected))
+        self.assertRaises(ValueError, select_random_items, self.items, 81, rng)
+
+    def test_select_random_items_weights(self):
+        items = [Item('a', 1), Item('b', 9)]
+        rng = random.Random(2)
+        counts = {'a': 0, 'b': 0}
+        for _ in range(2000):
+            counts[select_random_items(items, 1, rng)[0].name] += 1
+        self.assertTrue(1650 < counts['b'] < 1950)
+
+    def test_weighted_sampler(self):
+        sampler = WeightedSampler(self.items)
+        self.assertEqual(len(sampler), 80)
+        rng = random.Random(3)
+        self.assertTrue(all(sampler.draw(rng).probability > 0 for _ in range(200)))
+        selected = sampler.sample(80, rng)
+        self.assertEqual(len(set(selected)), 80)
+        self.assertEqual(sampler.total, 0)
+
+
 class TestJson(TestCase):
     fixtures = ('enemygen_testdata.json',)
 
@@ -381,6 +665,594 @@ class TestJson(TestCase):
         self.assertEqual(edict[0]['skills'][2]['Endurance'], enemy.skills_dict['Endurance'])
 
 
+class TestIndex(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        cache.clear()
+
+    def _add_templates(self, user, amount):
+        for i in range(amount):
+            et = EnemyTemplate(name='Listed %s' % i, owner=user, ruleset=Ruleset.objects.get(id=1),
+                               race=Race.objects.get(id=1), published=bool(i % 2))
+            et.save()
+            et.tags.add('tag%s' % i, 'common')
+            if i % 3:
+                Star(user=user, template=et).save()
+
+    def _index_json(self, user):
+        request = RequestFactory().get('/index_json/')
+        request.user = user
+        request.session = {}
+        with CaptureQueriesContext(connection) as queries:
+            response = views.index_json(request)
+        return json.loads(response.content.decode()), len(queries)
+
+    def _get(self, view, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = RequestFactory().get('/', **headers)
+        request.user = AnonymousUser()
+        request.session = {}
+        return view(request)
+
+    def test_index_json_query_count(self):
+        user = User(username='username')
+        user.save()
+        self._add_templates(user, 3)
+        templates, few_queries = self._index_json(user)
+        self.assertEqual(len([et for et in templates if et['name'].startswith('Listed')]), 3)
+        self._add_templates(user, 12)
+        templates, many_queries = self._index_json(user)
+        self.assertEqual(len([et for et in templates if et['name'].startswith('Listed')]), 15)
+        self.assertEqual(few_queries, many_queries)
+        listed = [et for et in templates if et['name'] == 'Listed 1'][0]
+        self.assertEqual(listed['tags'], ['common', 'tag1'])
+        self.assertEqual(listed['owner'], 'username')
+
+    def test_starred(self):
+        user = User(username='username')
+        user.save()
+        self._add_templates(user, 4)
+        starred = [et for et in get_enemy_templates(None, user) if et.name.startswith('Listed') and et.starred]
+        self.assertEqual(sorted(et.name for et in starred), ['Listed 1', 'Listed 2'])
+
+    def test_not_modified(self):
+        for view in (views.index_json, views.party_index_json):
+            response = self._get(view)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            with CaptureQueriesContext(connection) as queries:
+                response = self._get(view, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(len(queries), 1)  # The catalog version
+            with CaptureQueriesContext(connection) as queries:
+                cached = self._get(view)
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(cached.content, self._get(view).content)
+
+    def test_etag_changes_with_catalog(self):
+        response = self._get(views.index_json)
+        etag = response['ETag']
+        self.assertEqual(self._get(views.party_index_json)['ETag'], self._get(views.party_index_json)['ETag'])
+        et = get_enemy_template()
+        et.published = True
+        et.save()
+        response = self._get(views.index_json, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(et.id, [t['id'] for t in json.loads(response.content.decode())])
+        etag = response['ETag']
+        et.tags.add('fresh')
+        self.assertEqual(self._get(views.index_json, etag).status_code, 200)
+        etag = self._get(views.index_json)['ETag']
+        et.increment_generated([(et, 2)])
+        self.assertEqual(self._get(views.index_json, etag).status_code, 304)
+
+
+class TestSearch(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        self.user = User(username='username')
+        self.user.save()
+        self.race = Race.objects.get(id=1)
+
+    def _template(self, name, *tags):
+        et = EnemyTemplate(name=name, owner=self.user, ruleset=Ruleset.objects.get(id=1), race=self.race, published=True)
+        et.save()
+        et.tags.add(*tags)
+        return et
+
+    def _search(self, string):
+        return sorted(et.name for et in EnemyTemplate.search(string, AnonymousUser()) if et.owner == self.user)
+
+    def test_search(self):
+        self._template('Pirate Captain', 'sea', 'Brute')
+        self._template('Pirate', 'sea')
+        self._template('Bandit Captain', 'forest')
+        self.assertEqual(self._search('captain'), ['Bandit Captain', 'Pirate Captain'])
+        self.assertEqual(self._search('capt -pir'), ['Bandit Captain'])
+        self.assertEqual(self._search('pirate  SEA'), ['Pirate', 'Pirate Captain'])
+        self.assertEqual(self._search('brute'), ['Pirate Captain'])
+        self.assertEqual(self._search('st'), ['Bandit Captain'])  # forest
+        self.assertEqual(self._search('e'), ['Bandit Captain', 'Pirate', 'Pirate Captain'])
+        self.assertEqual(self._search(self.race.name[1:].upper()), ['Bandit Captain', 'Pirate', 'Pirate Captain'])
+        self.assertEqual(self._search('-'), ['Bandit Captain', 'Pirate', 'Pirate Captain'])
+        self.assertEqual(self._search('capain'), [])  # Same trigrams in different places
+
+    def test_index_follows_changes(self):
+        et = self._template('Pirate', 'sea')
+        et.name = 'Corsair'
+        et.save()
+        self.assertEqual(self._search('pirate'), [])
+        self.assertEqual(self._search('corsair'), ['Corsair'])
+        et.tags.remove('sea')
+        et.tags.add('ocean')
+        self.assertEqual(self._search('sea'), [])
+        self.assertEqual(self._search('ocean'), ['Corsair'])
+        tag = Tag.objects.get(name='ocean')
+        tag.name = 'waves'
+        tag.save()
+        self.assertEqual(self._search('waves'), ['Corsair'])
+        tag.delete()
+        self.assertEqual(self._search('waves'), [])
+        self.race.name = 'Zyzzyva'
+        self.race.save()
+        self.assertEqual(self._search('zyzz'), ['Corsair'])
+        trigrams = set(SearchTrigram.objects.filter(template=et).values_list('trigram', flat=True))
+        self.assertEqual(trigrams, SearchTrigram.trigrams('zyzzyva\ncorsair\n'))
+
+    def test_stale_save(self):
+        et = self._template('Corsair')
+        stale = EnemyTemplate.objects.get(id=et.id)
+        et.tags.add('ocean')
+        stale.notes = 'Sails at dawn'
+        stale.save()
+        self.assertEqual(EnemyTemplate.objects.get(id=et.id).search_text, et.get_search_text())
+        self.assertEqual(self._search('ocean'), ['Corsair'])
+
+    def _search_page(self, **params):
+        request = RequestFactory().get('/rest/search/', params)
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            response = ajax.search(request)
+        return json.loads(response.content.decode()), len(queries)
+
+    def test_search_pages(self):
+        for i in range(7):
+            et = self._template('Paged %s' % (6 - i), 'tag%s' % i, 'paged')
+            if i % 2:
+                Star(user=self.user, template=et).save()
+            EnemyTemplate.objects.filter(id=et.id).update(rank=i % 2 + 1)
+        names = []
+        starred = []
+        query_counts = set()
+        result = {'next': None}
+        while True:
+            params = {'string': 'paged', 'page_size': 3}
+            if result['next']:
+                params['cursor'] = result['next']
+            result, queries = self._search_page(**params)
+            self.assertLessEqual(len(result['results']), 3)
+            names.extend(row['name'] for row in result['results'])
+            starred.extend(row['name'] for row in result['results'] if row['starred'])
+            query_counts.add(queries)
+            if not result['next']:
+                break
+        self.assertEqual(names, ['Paged 0', 'Paged 2', 'Paged 4', 'Paged 6', 'Paged 1', 'Paged 3', 'Paged 5'])
+        self.assertEqual(sorted(starred), ['Paged 1', 'Paged 3', 'Paged 5'])
+        self.assertEqual(len(query_counts), 1)
+        result, _ = self._search_page(string='paged', cursor='invalid')
+        self.assertFalse(result['success'])
+
+    def test_update_search_index_command(self):
+        et = self._template('Pirate')
+        EnemyTemplate.objects.filter(id=et.id).update(search_text='')
+        SearchTrigram.objects.all().delete()
+        self.assertEqual(self._search('pirate'), [])
+        call_command('update_search_index', stdout=io.StringIO())
+        self.assertEqual(self._search('pirate'), ['Pirate'])
+
+
+class TestContext(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        cache.clear()
+
+    def _context(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        return get_context(request)
+
+    def test_generated_counter(self):
+        et = get_enemy_template()
+        total = self._context()['generated'] or 0
+        et.generate_many(3, increment=True)
+        et.generate(increment=True)
+        self.assertEqual(self._context()['generated'], total + 4)
+        self.assertEqual(Counter.get_value('generated'), EnemyTemplate.objects.aggregate(Sum('generated'))['generated__sum'])
+        et.delete()
+        self.assertEqual(self._context()['generated'], total)
+
+    def test_plain_counter(self):
+        Counter.add('export_cache_hits', 2)
+        Counter.add('export_cache_hits', 1)
+        self.assertEqual(Counter.get_value('export_cache_hits'), 3)
+
+    def test_sidebar_invalidation(self):
+        et = get_enemy_template()
+        self.assertNotIn('new_tag', [tag.name for tag in self._context()['all_et_tags']])
+        with CaptureQueriesContext(connection) as queries:
+            self._context()
+        self.assertEqual(len(queries), 1)  # Only the generated counter
+        et.tags.add('new_tag')
+        self.assertIn('new_tag', [tag.name for tag in self._context()['all_et_tags']])
+        et.tags.remove('new_tag')
+        self.assertNotIn('new_tag', [tag.name for tag in self._context()['all_et_tags']])
+
+    def test_sidebar_version(self):
+        et = get_enemy_template()
+        self._context()
+        et.generate(increment=True)
+        with CaptureQueriesContext(connection) as queries:
+            self._context()
+        self.assertEqual(len(queries), 1)
+        # A change saved by another worker process bumps the shared version, the local cache is then stale
+        Counter.add('sidebar_version', 1)
+        with CaptureQueriesContext(connection) as queries:
+            self._context()
+        self.assertGreater(len(queries), 1)
+
+
+class TestStatistics(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_statistics_snapshot(self):
+        et = get_enemy_template()
+        et.published = True
+        et.save()
+        with self.settings(TEMP=self.temp):
+            statistics = get_statistics()
+            self.assertTrue(os.path.exists(os.path.join(self.temp, 'statistics.json')))
+            self.assertIn({'name': 'username', 'template_amount': 1}, statistics['users'])
+            self.assertEqual(statistics['total_published_templates'],
+                             EnemyTemplate.objects.filter(published=True).exclude(race__name='Cult').count())
+            human = [race for race in statistics['races'] if race['name'] == 'Human'][0]
+            self.assertEqual(human['template_amount'], Race.objects.get(name='Human').templates.count())
+            # The view reads the snapshot until it is updated
+            et.delete()
+            self.assertEqual(get_statistics(), statistics)
+            call_command('update_statistics', stdout=io.StringIO())
+            self.assertNotIn({'name': 'username', 'template_amount': 1}, get_statistics()['users'])
+
+
+def _fake_pdf(html_path):
+    pdf_path = os.path.join(settings.TEMP, html_path.replace('.html', '.pdf'))
+    with open(pdf_path, 'wb') as f:
+        f.write(b'%PDF')
+    return pdf_path
+
+
+class TestExportJobs(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def _export(self):
+        with open(os.path.join(self.temp, 'rq_Test_abc123.html'), 'w') as f:
+            f.write('<html></html>')
+        response = self.client.get('/pdf_export/', {'action': 'pdf_export', 'generated_html': 'rq_Test_abc123.html'})
+        self.assertEqual(response.status_code, 200)
+        return response.context['job']
+
+    def _status(self, job):
+        return json.loads(self.client.get('/export_status/%s/' % job.id).content.decode())
+
+    def test_pdf_export_job(self):
+        with self.settings(TEMP=self.temp):
+            job = self._export()
+            self.assertEqual(self._status(job), {'status': 'queued'})
+            with mock.patch('enemygen.views_lib.generate_pdf', _fake_pdf):
+                call_command('render_exports', once=True, stdout=io.StringIO())
+            status = self._status(job)
+            self.assertEqual(status['status'], 'done')
+            response = self.client.get(status['download'])
+            self.assertEqual(response.content, b'%PDF')
+            self.assertEqual(response['Content-Disposition'], 'attachment; filename="rq_Test.pdf"')
+
+    def test_failed_job(self):
+        with self.settings(TEMP=self.temp):
+            job = self._export()
+            with mock.patch('enemygen.views_lib.generate_pdf', side_effect=IOError('broken')):
+                call_command('render_exports', once=True, stdout=io.StringIO())
+            self.assertEqual(self._status(job)['status'], 'failed')
+            self.assertEqual(self.client.get('/export_download/%s/' % job.id).status_code, 404)
+
+    def test_claim_once(self):
+        job = ExportJob.objects.create(html_file='a.html')
+        self.assertEqual(ExportJob.claim_next(), job)
+        self.assertIsNone(ExportJob.claim_next())
+        self.assertEqual(ExportJob.requeue_stale(-1), 1)
+        self.assertEqual(ExportJob.claim_next(), job)
+
+    def test_worker_survives_errors(self):
+        class Stop(BaseException):
+            pass
+        calls = [OSError('MySQL server has gone away'), None, Stop()]
+        def process():
+            result = calls.pop(0)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        with mock.patch('enemygen.management.commands.render_exports.process_export_job', process), \
+                mock.patch('enemygen.management.commands.render_exports.close_old_connections') as close, \
+                mock.patch('time.sleep'), self.assertLogs('enemygen.management.commands.render_exports', 'ERROR'):
+            self.assertRaises(Stop, render_exports._work, 0, 300)
+        self.assertEqual(calls, [])
+        close.assert_called_once_with()
+
+    def test_delete_old_jobs(self):
+        with self.settings(TEMP=self.temp):
+            for name in ('old.pdf', 'shared.pdf'):
+                with open(os.path.join(self.temp, name), 'w') as f:
+                    f.write('%PDF')
+            old = timezone.now() - datetime.timedelta(days=2)
+            ExportJob.objects.create(html_file='a.html', status='done', result_file='old.pdf', finished=old)
+            ExportJob.objects.create(html_file='b.html', status='done', result_file='shared.pdf', finished=old)
+            ExportJob.objects.create(html_file='c.html', status='failed', finished=old)
+            ExportJob.objects.create(html_file='d.html', status='done', result_file='shared.pdf', finished=timezone.now())
+            ExportJob.objects.create(html_file='e.html')
+            out = io.StringIO()
+            call_command('sweep_temp', stdout=out)
+            self.assertEqual(out.getvalue().split('\n')[0], 'Deleted 3 export jobs')
+            self.assertEqual(sorted(ExportJob.objects.values_list('html_file', flat=True)), ['d.html', 'e.html'])
+            self.assertEqual(os.listdir(self.temp), ['shared.pdf'])
+
+
+class _FakeHTML(object):
+    def __init__(self, filename=None, string=None, base_url=None):
+        self.string = string if filename is None else open(filename).read()
+
+    def write_png(self, png_path, stylesheets=None):
+        with open(png_path, 'w') as f:
+            f.write(self.string)
+
+    def write_pdf(self, pdf_path):
+        self.write_png(pdf_path)
+
+
+class TestPngExport(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_generate_pngs(self):
+        enemies = ''.join('<div class="enemy_container">Enemy %s</div>' % i for i in range(5))
+        with open(os.path.join(self.temp, 'enemies.html'), 'w') as f:
+            f.write('<html><body><div id="enemies">%s</div></body></html>' % enemies)
+        # The spawned workers of the real pool wouldn't see the mocks, threads run the same code here
+        with self.settings(TEMP=self.temp, PNG_RENDER_WORKERS=3), \
+                mock.patch('enemygen.views_lib.HTML', _FakeHTML, create=True), \
+                mock.patch('enemygen.views_lib.CSS', mock.Mock(), create=True), \
+                mock.patch('enemygen.views_lib._trim'), ThreadPoolExecutor(3) as pool, \
+                mock.patch('enemygen.views_lib._get_png_pool', return_value=pool) as get_pool:
+            paths = generate_pngs('enemies.html')
+        get_pool.assert_called_once_with()
+        self.assertEqual(len(paths), 5)
+        for i, path in enumerate(paths):
+            with open(path) as f:
+                content = f.read()
+            self.assertIn('Enemy %s' % i, content)
+            self.assertEqual(content.count('enemy_container'), 1)
+
+
+    def test_png_pool(self):
+        with self.settings(PNG_RENDER_WORKERS=2):
+            pool = views_lib._get_png_pool()
+            try:
+                self.assertIs(views_lib._get_png_pool(), pool)
+                self.assertEqual(pool._mp_context.get_start_method(), 'spawn')
+            finally:
+                views_lib._forget_png_pool()
+        self.assertIsNone(views_lib._png_pool)
+
+    def _export(self, function):
+        with self.settings(TEMP=self.temp, PNG_RENDER_WORKERS=1), \
+                mock.patch('enemygen.views_lib.HTML', _FakeHTML, create=True), \
+                mock.patch('enemygen.views_lib.CSS', mock.Mock(), create=True), \
+                mock.patch('enemygen.views_lib._trim'), \
+                mock.patch('enemygen.views_lib.Counter') as counter:
+            return function('enemies.html'), [call[0][0] for call in counter.add.call_args_list]
+
+    def test_export_cache(self):
+        enemies = ''.join('<div class="enemy_container">Enemy %s</div>' % i for i in range(3))
+        with open(os.path.join(self.temp, 'enemies.html'), 'w') as f:
+            f.write('<html><body><div id="enemies">%s</div></body></html>' % enemies)
+        paths, counts = self._export(generate_pngs)
+        self.assertEqual(counts, ['export_cache_misses'] * 3)
+        cached_paths, counts = self._export(generate_pngs)
+        self.assertEqual(cached_paths, paths)
+        self.assertEqual(counts, ['export_cache_hits'] * 3)
+        pdf_path, counts = self._export(generate_pdf)
+        self.assertEqual(self._export(generate_pdf), (pdf_path, ['export_cache_hits']))
+        # A changed stylesheet version is a cache miss
+        with self.settings(EXPORT_STYLESHEET_VERSION=2):
+            self.assertNotEqual(self._export(generate_pdf)[0], pdf_path)
+
+    def test_evict_export_cache(self):
+        with self.settings(TEMP=self.temp):
+            cache_dir = os.path.dirname(views_lib._export_cache_path('', '.pdf'))
+            for i in range(4):
+                with open(os.path.join(cache_dir, '%s.png' % i), 'wb') as f:
+                    f.write(b'x' * 100)
+                os.utime(os.path.join(cache_dir, '%s.png' % i), (time.time() - 100 + i, time.time() - 100 + i))
+            os.utime(os.path.join(cache_dir, '0.png'))  # Recently used
+            self.assertEqual(evict_export_cache(250), 2)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['0.png', '3.png'])
+
+
+class TestTempStore(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def _age(self, path, seconds):
+        os.utime(path, (time.time() - seconds, time.time() - seconds))
+
+    def _write(self, name, content=b''):
+        path = temp_store.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_sharded_files(self):
+        with self.settings(TEMP=self.temp):
+            name = 'rq_Test_0123456789ab.html'
+            path = self._write(name)
+            self.assertEqual(os.path.dirname(os.path.dirname(path)), self.temp)
+            self.assertEqual(temp_store.find(name), path)
+            with open(os.path.join(self.temp, 'rq_legacy.html'), 'w') as f:
+                f.write('')
+            self.assertEqual(temp_store.find('rq_legacy.html'), os.path.join(self.temp, 'rq_legacy.html'))
+            self.assertIsNone(temp_store.find('rq_missing.html'))
+
+    def test_sweep(self):
+        with self.settings(TEMP=self.temp):
+            paths = []
+            for i in range(5):
+                path = self._write('rq_%s.html' % i, b'x' * 100)
+                self._age(path, 100 - i)
+                paths.append(path)
+            self._age(paths[0], 10000)  # Expired
+            temp_store.touch(paths[1])  # Recently used
+            with open(os.path.join(self.temp, 'statistics.json'), 'w') as f:
+                f.write('{}')
+            self._age(os.path.join(self.temp, 'statistics.json'), 10000)
+            out = io.StringIO()
+            call_command('sweep_temp', ttl=1000, max_bytes=250, stdout=out)
+            self.assertEqual(out.getvalue().split('\n')[1], 'Deleted 3 files, reclaimed 300 bytes')
+            self.assertEqual([os.path.exists(path) for path in paths], [False, True, False, False, True])
+            self.assertTrue(os.path.exists(os.path.join(self.temp, 'statistics.json')))
+
+
+class TestEncounter(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_lazy_html(self):
+        et = get_enemy_template()
+        with self.settings(TEMP=self.temp):
+            response = self.client.post('/generate_enemies/', {'enemy_template_id_%s' % et.id: '3'})
+            self.assertEqual(os.listdir(self.temp), [])  # Nothing is written before an export
+            encounter = response.context['encounter']
+            names = [enemy.name for enemy in response.context['enemies']]
+            file_name = save_encounter_html(encounter)
+            self.assertTrue(file_name.startswith('rq_Test_Template_'))
+            with open(get_html_path(file_name)) as f:
+                content = f.read()
+            for name in names:
+                self.assertIn(name, content)
+            self.assertEqual(save_encounter_html(encounter), file_name)
+            et.refresh_from_db()
+            self.assertEqual(et.generated, 3)  # Rendering the html doesn't count as generating
+
+    def test_changed_template(self):
+        et = get_enemy_template()
+        with self.settings(TEMP=self.temp):
+            response = self.client.post('/generate_enemies/', {'enemy_template_id_%s' % et.id: '2'})
+            EnemyStat.objects.filter(enemy_template=et).update(die_set='100')
+            self.assertRaises(ValidationError, save_encounter_html, response.context['encounter'])
+            self.assertRaises(ValidationError, save_encounter_html, response.context['encounter'] + 'x')
+
+    def test_change_template(self):
+        et = get_enemy_template()
+        with self.settings(TEMP=self.temp):
+            response = self.client.post('/generate_enemies/', {'enemy_template_id_%s' % et.id: '2'})
+            encounter = response.context['encounter']
+            for value in ('Bob', 'Grog', 'Grog the Great'):
+                self.client.post('/rest/change_template/', json.dumps({'encounter': encounter, 'id': 'enemy_1', 'value': value}),
+                                 content_type='application/json')
+            self.client.post('/rest/change_template/', json.dumps({'encounter': encounter, 'id': 'enemy_2', 'value': 'Tim'}),
+                             content_type='application/json')
+            self.assertFalse(any(name.endswith('.html') for _, _, names in os.walk(self.temp) for name in names))
+            _, soup = read_sheet(save_encounter_html(encounter))
+            self.assertEqual(soup.find('span', {'id': 'enemy_1'}).text, 'Grog the Great')
+            self.assertEqual(soup.find('span', {'id': 'enemy_2'}).text, 'Tim')
+            self.assertIn('template_name', soup.find('span', {'id': 'enemy_1'})['class'])
+
+    def test_party(self):
+        et = get_enemy_template()
+        party = Party(name='Test Party', owner=et.owner)
+        party.save()
+        TemplateToParty(template=et, party=party, amount='1d4').save()
+        with self.settings(TEMP=self.temp):
+            response = self.client.post('/generate_party/', {'party_id': party.id})
+            file_name = save_encounter_html(response.context['encounter'])
+            self.assertTrue(file_name.startswith('rq_Test_Party_'))
+
+
+class TestGenerateJson(TestCase):
+    fixtures = ('enemygen_testdata.json',)
+
+    def test_ndjson(self):
+        et = get_enemy_template()
+        response = self.client.get('/generate_enemies_json/', {'id': et.id, 'amount': 5, 'format': 'ndjson', 'seed': 3})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Test Template %s' % i for i in range(1, 6)])
+        # Same enemies as the json format
+        response = self.client.get('/generate_enemies_json/', {'id': et.id, 'amount': 5, 'seed': 3})
+        self.assertEqual(json.loads(response.content.decode()), [json.loads(line) for line in lines])
+        et.refresh_from_db()
+        self.assertEqual(et.generated, 10)
+
+    def test_encounter_json(self):
+        et = get_enemy_template()
+        et2 = EnemyTemplate.create(et.owner, et.ruleset, et.race, 'Second Template')
+        specs = [{'id': et.id, 'amount': 2}, {'id': et2.id, 'amount': '3'}, {'id': 'x'}, {'id': 99999}, 'junk', {'id': et.id}]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/generate_encounter_json/', json.dumps(specs), content_type='application/json')
+        names = [enemy['name'] for enemy in json.loads(response.content.decode())]
+        self.assertEqual(names, ['Test Template 1', 'Test Template 2', 'Second Template 1', 'Second Template 2',
+                                 'Second Template 3', 'Test Template 1'])
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "enemygen_enemytemplate"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual([(t.generated, t.used) for t in EnemyTemplate.objects.filter(id__in=(et.id, et2.id)).order_by('id')],
+                         [(3, 1), (3, 1)])
+        self.assertEqual(response['Access-Control-Allow-Methods'], 'POST, OPTIONS')
+        response = self.client.post('/generate_encounter_json/', '{"id": 1}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_max_amount(self):
+        et = get_enemy_template()
+        with self.settings(GENERATE_JSON_MAX_AMOUNT=3):
+            response = self.client.get('/generate_enemies_json/', {'id': et.id, 'amount': 100, 'format': 'ndjson'})
+            self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 3)
+            response = self.client.get('/generate_enemies_json/', {'id': et.id, 'amount': 100})
+            self.assertEqual(len(json.loads(response.content.decode())), 3)
+
+
 class TestPublicCors(SimpleTestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -8,6 +8,7 @@ try:
     ROOT = settings.WEB_ROOT
 except:
     ROOT = ''
+UUID = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
 urlpatterns = [
     url('^' + ROOT + r'$', views.home, name='home'),
@@ -33,9 +34,12 @@ urlpatterns = [
     url('^' + ROOT + r'feature_items/(?P<feature_id>\d+)/$', views.feature_items, name='feature_items'),
     url('^' + ROOT + r'generate_enemies_json/$', views.generate_enemies_json),
     url('^' + ROOT + r'generate_party_json/$', views.generate_party_json),
+    url('^' + ROOT + r'generate_encounter_json/$', views.generate_encounter_json),
 
     url('^' + ROOT + r'pdf_export/$', views.pdf_export, name='pdf_export'),
     url('^' + ROOT + r'png_export/$', views.png_export, name='png_export'),
+    url('^' + ROOT + r'export_status/(?P<job_id>' + UUID + ')/$', views.export_status, name='export_status'),
+    url('^' + ROOT + r'export_download/(?P<job_id>' + UUID + ')/$', views.export_download, name='export_download'),
     url('^' + ROOT + r'delete_template/(?P<template_id>\d+)/$', views.delete_template, name='delete_template'),
     url('^' + ROOT + r'race_index/$', views.race_index, name='race_index'),
     url('^' + ROOT + r'clone_race/(?P<race_id>\d+)/$', views.clone_race, name='clone_race'),
@@ -1,20 +1,26 @@
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.conf import settings
 from django.utils.datastructures import MultiValueDictKeyError
-from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import get_conditional_response, patch_cache_control
 
-from enemygen.models import EnemyTemplate, Race, Party, ChangeLog, AdditionalFeatureList
+from enemygen.models import EnemyTemplate, Race, Party, ChangeLog, AdditionalFeatureList, ExportJob
 from enemygen.views_lib import get_ruleset, get_context, get_et_context, get_enemies, get_generated_party
 from enemygen.views_lib import get_enemy_templates, is_race_admin, get_statistics, get_random_party
-from enemygen.views_lib import get_filter, get_party_templates, save_as_html
-from enemygen.views_lib import get_party_context, get_enemies_lucky, get_party_filter, determine_enemies, as_json, enemy_as_json
+from enemygen.views_lib import get_filter, get_party_templates, get_encounter
+from enemygen.views_lib import get_party_context, get_lucky_index, get_party_filter, determine_enemies, as_json, enemy_as_json
+from enemygen.views_lib import get_rng, determine_enemy_specs, catalog_etag, cached_catalog_json
 from enemygen import views_lib as lib
+from enemygen.enemygen_lib import ValidationError
 
 import os
 import json
+import random
 
 
 def index(request):
@@ -41,13 +47,25 @@ def simple_index(request):
 
 @require_GET
 def index_json(request):
-    out = []
-    for et in get_enemy_templates(get_filter(request), request.user):
-        out.append({
-            'name': et.name, 'race': et.race.name, 'rank': et.rank, 'owner': et.owner.username,
-            'tags': et.get_tags(), 'id': et.id, 'notes': et.notes
-        })
-    return HttpResponse(json.dumps(out), content_type="application/json")
+    filtr = get_filter(request)
+    etag = catalog_etag(request, 'templates', filtr)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        def build():
+            out = [{
+                'name': et.name, 'race': et.race.name, 'rank': et.rank, 'owner': et.owner.username,
+                'tags': et.get_tags(), 'id': et.id, 'notes': et.notes
+            } for et in get_enemy_templates(filtr, request.user)]
+            return json.dumps(out)
+        response = HttpResponse(cached_catalog_json(etag, build), content_type="application/json")
+    return _catalog_response(response, etag)
+
+
+def _catalog_response(response, etag):
+    """ Clients must revalidate the listings, which is cheap with the ETag """
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+    return response
 
 def home(request):
     context = get_context(request)
@@ -63,35 +81,44 @@ def party_index(request):
 
 @require_GET
 def party_index_json(request):
-    out = []
-    for party in get_party_templates(get_party_filter(request)):
-        party_json = {
-            'name': party.name, 'owner': party.owner.username, 'tags': party.get_tags(), 'id': party.id, 'templates': []
-        }
-        for template in party.template_specs:
-            party_json['templates'].append({
-                'name': template.template.name,
-                'amount': template.amount,
-                'id': template.template.id,
-            })
-        out.append(party_json)
-
-    return HttpResponse(json.dumps(out), content_type="application/json")
+    filtr = get_party_filter(request)
+    etag = catalog_etag(request, 'parties', filtr)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        def build():
+            out = []
+            for party in get_party_templates(filtr):
+                party_json = {
+                    'name': party.name, 'owner': party.owner.username, 'tags': party.get_tags(), 'id': party.id,
+                    'templates': []
+                }
+                for template in party.template_specs:
+                    party_json['templates'].append({
+                        'name': template.template.name,
+                        'amount': template.amount,
+                        'id': template.template.id,
+                    })
+                out.append(party_json)
+            return json.dumps(out)
+        response = HttpResponse(cached_catalog_json(etag, build), content_type="application/json")
+    return _catalog_response(response, etag)
 
 
 def generate_enemies(request):
     if not request.POST:
         return redirect('index')
     context = get_context(request)
+    seed = random.getrandbits(64)
     if request.POST.get('lucky', None):
-        context['enemies'] = get_enemies_lucky(request)
+        enemy_index = get_lucky_index(request)
+        context['enemies'] = get_enemies(enemy_index, False, random.Random(seed))
         context['single_template'] = True
     else:
         enemy_index = determine_enemies(request.POST)
         increment = False if request.POST.get('dont_increment') else True  # Increment the number of enemies generated
-        context['enemies'] = get_enemies(enemy_index, increment)
+        context['enemies'] = get_enemies(enemy_index, increment, random.Random(seed))
         context['single_template'] = (len(enemy_index) == 1)
-    context['generated_html'] = save_as_html(context, 'generated_enemies.html')
+    context['encounter'] = get_encounter(context, seed, enemy_index)
     return render(request, 'generated_enemies.html', context)
 
 
@@ -108,19 +135,42 @@ def generate_enemies_json(request):
         amount = int(amount)
     except ValueError:
         amount = 1
-    et = get_object_or_404(EnemyTemplate, id=template_id)
-    enemy_index = ((et, int(amount)),)
-    enemies = get_enemies(enemy_index, True)
+    amount = max(min(amount, getattr(settings, 'GENERATE_JSON_MAX_AMOUNT', 10000)), 0)
+    et = get_object_or_404(EnemyTemplate.objects.select_related('race'), id=template_id)
+    if request.GET.get('format') == 'ndjson':
+        # One enemy per line. The enemies are generated while streaming, so memory use doesn't grow with amount
+        enemies = et.iter_generate(amount, True, get_rng(request))
+        lines = (json.dumps(enemy_as_json(enemy)) + '\n' for enemy in enemies)
+        return StreamingHttpResponse(lines, content_type="application/x-ndjson")
+    enemies = et.generate_many(amount, True, get_rng(request))
     enemies_json = as_json(enemies)
     return HttpResponse(enemies_json, content_type="application/json")
 
 
+@csrf_exempt
+@require_POST
+def generate_encounter_json(request):
+    """ Generates the enemies of several templates at once.
+        Input: json list of {"id": template id, "amount": amount}. Optional GET parameter seed.
+    """
+    try:
+        specs = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid json')
+    if not isinstance(specs, list):
+        return HttpResponseBadRequest('Expected a list of {"id": template id, "amount": amount}')
+    enemy_index = determine_enemy_specs(specs)
+    EnemyTemplate.increment_generated(enemy_index)
+    enemies = get_enemies(enemy_index, False, get_rng(request))
+    return HttpResponse(as_json(enemies), content_type="application/json")
+
+
 def generate_party_json(request):
     try:
         party_object = Party.objects.get(id=request.GET['id'])
     except (Party.DoesNotExist, MultiValueDictKeyError):
         raise Http404
-    party = get_generated_party(party_object)
+    party = get_generated_party(party_object, get_rng(request))
     out = {'enemies': [], 'party_name': party['party'].name, 'additional_features': []}
     for enemy in party['enemies']:
         out['enemies'].append(enemy_as_json(enemy))
@@ -139,8 +189,9 @@ def generate_party(request):
         party_object = get_random_party(party_filter)
     else:
         party_object = Party.objects.get(id=request.POST['party_id'])
-    context.update(get_generated_party(party_object))
-    context['generated_html'] = save_as_html(context, 'generated_enemies.html')
+    seed = random.getrandbits(64)
+    context.update(get_generated_party(party_object, random.Random(seed)))
+    context['encounter'] = get_encounter(context, seed)
     return render(request, 'generated_enemies.html', context)
 
 
@@ -248,34 +299,66 @@ def set_party_filter(request):
     return redirect(index)
 
 
+def _get_export_html(request):
+    """ Returns the name of the html file to be exported. The html of a generated encounter is rendered when
+        it's exported for the first time. Links to html files saved before encounters are still supported.
+    """
+    if request.GET.get('encounter'):
+        return lib.save_encounter_html(request.GET['encounter'])
+    return lib.sanitize_html_path(request.GET.get('generated_html', ''))
+
+
 def pdf_export(request):
     if request.GET and request.GET.get('action') == 'pdf_export':
-        file_name = lib.sanitize_html_path(request.GET.get('generated_html'))
+        try:
+            file_name = _get_export_html(request)
+        except ValidationError as e:
+            return HttpResponse(str(e), status=409, content_type='text/plain')
         if not file_name:
             return redirect('home')
-        pdf_path = lib.generate_pdf(file_name)
-        file_name, extension = os.path.splitext(os.path.basename(pdf_path))
-        file_name = '_'.join(file_name.split('_')[:-1])  # Remove the last unique identifier from file name
-        file_name = file_name.replace(',', '')
-        file_name += extension
-        data = open(pdf_path, 'rb').read()
-        response = HttpResponse(data, content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
-        response['Content-Length'] = len(data)
-        return response
+        # The PDF is rendered by the render_exports workers, the page polls export_status until it's ready
+        context = get_context(request)
+        context['job'] = lib.enqueue_pdf_export(file_name)
+        return render(request, 'export_job.html', context)
     return redirect('home')
 
 
+@require_GET
+def export_status(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id)
+    out = {'status': job.status}
+    if job.status == 'done':
+        out['download'] = reverse('export_download', args=(job.id, ))
+    elif job.status == 'failed':
+        out['error'] = 'Export failed'
+    return HttpResponse(json.dumps(out), content_type="application/json")
+
+
+@require_GET
+def export_download(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id, status='done')
+    pdf_path = os.path.join(settings.TEMP, job.result_file)
+    if not os.path.isfile(pdf_path):
+        raise Http404
+    data = open(pdf_path, 'rb').read()
+    response = HttpResponse(data, content_type='application/pdf')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % lib.export_file_name(job.html_file, '.pdf')
+    response['Content-Length'] = len(data)
+    return response
+
+
 def png_export(request):
     if request.GET and request.GET.get('action') == 'png_export':
-        file_name = lib.sanitize_html_path(request.GET.get('generated_html'))
+        try:
+            file_name = _get_export_html(request)
+        except ValidationError as e:
+            return HttpResponse(str(e), status=409, content_type='text/plain')
         if not file_name:
             return redirect('home')
         png_paths = lib.generate_pngs(file_name)
         new_paths = []
         for path in png_paths:
-            fileName = os.path.basename(path)
-            new_paths.append('/temp/' + fileName)
+            new_paths.append('/temp/' + os.path.relpath(path, settings.TEMP))
         return render(request, 'generated_enemies_as_pngs.html', {'png_paths': new_paths})
     return redirect('home')
 
@@ -2,25 +2,41 @@
 
 from enemygen.models import Ruleset, EnemyTemplate, Race
 from enemygen.models import SpellAbstract, EnemySpell, CustomSpell, ChangeLog
-from enemygen.models import Weapon, CombatStyle, EnemyWeapon, CustomWeapon, Party, AdditionalFeatureList
+from enemygen.models import Weapon, CombatStyle, EnemyWeapon, CustomWeapon, Party, AdditionalFeatureList, Star
+from enemygen.models import Counter, ExportJob, SIDEBAR_CACHE_KEY, SIDEBAR_VERSION, CATALOG_VERSION
+from enemygen import temp_store
+from enemygen.enemygen_lib import ValidationError
 
-from django.contrib.auth.models import User
 from django.template.loader import render_to_string
-from django.db.models import Q, Sum
+from django.db.models import Q, Count
 from django.conf import settings
+from django.core.cache import cache
+from django.core import signing
 
 from bs4 import BeautifulSoup
 from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import django
+import multiprocessing
 import os
 import random
 import datetime
 import json
+import hashlib
+from collections import OrderedDict
 try:
     from weasyprint import HTML, CSS
     from PIL import Image, ImageChops
 except:
     pass
 
+ENCOUNTER_SALT = 'enemygen.encounter'
+SEARCH_CURSOR_SALT = 'enemygen.search'
+EXPORT_CACHE = 'export_cache'
+PNG_STYLESHEET = '@media print{body, td, th{font-size: 11px !important;}}'
+
+
 def get_filter(request):
     return request.session.get('filter', None)
 
@@ -34,18 +50,35 @@ def get_ruleset(request):
 
 
 def get_context(request):
+    counters = Counter.get_values('generated', SIDEBAR_VERSION)
+    sidebar = _get_sidebar_data(counters[SIDEBAR_VERSION])
     context = {'filter': get_filter(request),
                'party_filter': get_party_filter(request),
-               'generated': _get_generated_amount(),
+               'generated': counters['generated'],
                'request': request,
-               'all_et_tags': sorted(list(EnemyTemplate.tags.all()), key=lambda x: x.name),
-               'all_party_tags': sorted(list(Party.tags.all()), key=lambda x: x.name)
+               'all_et_tags': sidebar['all_et_tags'],
+               'all_party_tags': sidebar['all_party_tags'],
                }
-    if (datetime.date.today() - ChangeLog.objects.all().reverse()[0].publish_date).days < 14:
+    if (datetime.date.today() - sidebar['latest_change']).days < 14:
         context['recent_changes'] = True
     return context
 
 
+def _get_sidebar_data(version):
+    """ The tag lists and the latest changelog date are cached until tags, templates, parties or changelogs change.
+        See models.forget_sidebar_data
+    """
+    key = '%s_%s' % (SIDEBAR_CACHE_KEY, version)
+    data = cache.get(key)
+    if data is None:
+        data = {'all_et_tags': sorted(list(EnemyTemplate.tags.all()), key=lambda x: x.name),
+                'all_party_tags': sorted(list(Party.tags.all()), key=lambda x: x.name),
+                'latest_change': ChangeLog.objects.all().reverse()[0].publish_date,
+                }
+        cache.set(key, data, getattr(settings, 'SIDEBAR_CACHE_TIMEOUT', 3600))
+    return data
+
+
 def get_et_context(et):
     context = {'et': et,
                'theism_spells': spell_list('theism', et),
@@ -62,10 +95,11 @@ def get_et_context(et):
 
 
 def get_party_templates(filtr=None):
+    queryset = Party.objects.filter(published=True).select_related('owner').prefetch_related('tags')
     if filtr and filtr != 'None':
-        parties = list(Party.objects.filter(tags__name__in=[filtr, ], published=True))
+        parties = list(queryset.filter(tags__name__in=[filtr, ]))
     else:
-        parties = list(Party.objects.filter(published=True))
+        parties = list(queryset)
     return parties
 
 
@@ -78,8 +112,13 @@ def get_party_context(party):
     return context
 
 
+def _listed_templates():
+    """ Queryset for template listings. Race, owner and tags are fetched with the templates """
+    return EnemyTemplate.objects.order_by('rank').exclude(race__name='Cult').select_related('race', 'owner').prefetch_related('tags')
+
+
 def get_enemy_templates(filtr, user):
-    published_templates = EnemyTemplate.objects.filter(published=True).order_by('rank').exclude(race__name='Cult').select_related('race')
+    published_templates = _listed_templates().filter(published=True)
     if filtr and filtr not in ('None', 'Starred'):
         templates = list(published_templates.filter(tags__name__in=[filtr, ]))
     elif filtr == 'Starred':
@@ -88,17 +127,62 @@ def get_enemy_templates(filtr, user):
         templates = list(published_templates)
     if user.is_authenticated:
         # Add the unpublished templates of the logged-in user
-        unpubl = EnemyTemplate.objects.filter(published=False, owner=user).order_by('rank').exclude(race__name='Cult').select_related('race')
+        unpubl = _listed_templates().filter(published=False, owner=user)
         if filtr:
             templates.extend(list(unpubl.filter(tags__name__in=[filtr, ])))
         else:
             templates.extend(list(unpubl))
         # Add stars (We can't call is_starred with the user parameter in Django template)
+        starred = set(Star.objects.filter(user=user).values_list('template_id', flat=True))
         for et in templates:
-            et.starred = et.is_starred(user)
+            et.starred = et.id in starred
     return templates
 
 
+def catalog_etag(request, listing, filtr):
+    """ ETag of a template or party listing. Changes with the catalog version, and differs per filter and user """
+    version = Counter.get_value(CATALOG_VERSION)
+    key = '%s:%s:%s:%s' % (listing, filtr, request.user.id or 0, version)
+    return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def cached_catalog_json(etag, build):
+    """ Returns the json of the listing with the given ETag. build() serializes the listing when it's not cached """
+    key = 'enemygen_catalog_%s' % etag.strip('"')
+    body = cache.get(key)
+    if body is None:
+        body = build()
+        cache.set(key, body, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 3600))
+    return body
+
+
+def search_templates(string, user, rank_filter=None, cult_rank_filter=None, cursor=None, page_size=None):
+    """ Returns a page of the search results in (rank, name, id) order, and the cursor of the next page or None.
+        The page starts after the template of the given cursor. Tags and stars are fetched for the page at once.
+    """
+    max_page_size = getattr(settings, 'SEARCH_PAGE_SIZE', 100)
+    page_size = min(max(int(page_size or max_page_size), 1), max_page_size)
+    queryset = EnemyTemplate.search(string, user, rank_filter, cult_rank_filter).order_by('rank', 'name', 'id')
+    if cursor:
+        try:
+            rank, name, et_id = signing.loads(cursor, salt=SEARCH_CURSOR_SALT)
+        except (signing.BadSignature, ValueError):
+            raise ValidationError('Invalid cursor')
+        queryset = queryset.filter(Q(rank__gt=rank) | Q(rank=rank, name__gt=name) | Q(rank=rank, name=name, id__gt=et_id))
+    templates = list(queryset.prefetch_related('tags')[:page_size + 1])
+    next_cursor = None
+    if len(templates) > page_size:
+        templates = templates[:page_size]
+        last = templates[-1]
+        next_cursor = signing.dumps([last.rank, last.name, last.id], salt=SEARCH_CURSOR_SALT)
+    starred = set()
+    if user.is_authenticated:
+        starred = set(Star.objects.filter(user=user, template__in=templates).values_list('template_id', flat=True))
+    for et in templates:
+        et.starred = et.id in starred
+    return templates, next_cursor
+
+
 def determine_enemies(post):
     """ Determines the EnemyTemplates to be used and the amounts to be generated based on the POST data
         Output is a list of tuples of (EnemyTemplate, amount)
@@ -123,21 +207,47 @@ def determine_enemies(post):
     return index
 
 
-def get_enemies(index, increment):
+def determine_enemy_specs(specs):
+    """ Like determine_enemies, but based on a list of {'id': template id, 'amount': amount} dicts.
+        The templates are loaded with a single query. The total amount is limited to
+        settings.GENERATE_JSON_MAX_AMOUNT. Output is a list of tuples of (EnemyTemplate, amount)
+    """
+    wanted = []
+    for spec in specs:
+        try:
+            wanted.append((int(spec['id']), int(spec.get('amount', 1))))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            continue
+    templates = EnemyTemplate.objects.select_related('race').in_bulk([et_id for et_id, _ in wanted])
+    remaining = getattr(settings, 'GENERATE_JSON_MAX_AMOUNT', 10000)
+    index = []
+    for et_id, amount in wanted:
+        amount = min(amount, remaining)
+        if et_id in templates and amount > 0:
+            index.append((templates[et_id], amount))
+            remaining -= amount
+    return index
+
+
+def get_enemies(index, increment, rng=None):
     """ Generates the enemies.
         Input: a list of tuples of (EnemyTemplate, amount)
     """
     enemies = []
     for et, amount in index:
-        if increment:
-            et.increment_used()
-        for i in range(amount):
-            enemies.append(et.generate(i+1, increment))
+        enemies.extend(et.generate_many(amount, increment, rng))
     return enemies
 
 
-def get_enemies_lucky(request):
-    """ Returns a six instances of a randomly selected enemy based on the current filter """
+def get_rng(request):
+    """ Returns a random.Random seeded with the optional 'seed' GET parameter. The same seed gives the same
+        enemies as long as the templates don't change.
+    """
+    return random.Random(request.GET.get('seed'))
+
+
+def get_lucky_index(request):
+    """ Returns an index of six instances of a randomly selected enemy based on the current filter """
     filtr = get_filter(request)
     if filtr and filtr != 'None':
         templates = EnemyTemplate.objects.filter(tags__name__in=[filtr, ], published=True)
@@ -146,10 +256,8 @@ def get_enemies_lucky(request):
     else:
         templates = EnemyTemplate.objects.filter(published=True)
     index = random.randint(0, len(templates)-1) 
-    enemies = []
-    for i in range(6):
-        enemies.append(templates[index].generate(i+1))
-    return enemies
+    et = templates[index]
+    return [(et, 6)]
 
 
 def get_random_party(filtr=None):
@@ -161,30 +269,24 @@ def get_random_party(filtr=None):
     return parties[index]
 
 
-def get_generated_party(party):
+def get_generated_party(party, rng=None, increment=True):
+    """ rng is an optional random.Random instance used for all the rolls of the party """
     context = {'party': party,
-               'enemies': _get_party_enemies(party),
-               'party_additional_features': party.get_random_additional_features()}
+               'enemies': _get_party_enemies(party, rng, increment),
+               'party_additional_features': party.get_random_additional_features(rng)}
     nonrandom_feature = [item.feature for item in party.nonrandom_features]
     context['party_additional_features'].extend(nonrandom_feature)
     return context
 
 
-def _get_party_enemies(party):
+def _get_party_enemies(party, rng=None, increment=True):
     enemies = []
     for ttp in party.template_specs:
-        et = ttp.template
-        amount = ttp.get_amount()
-        et.increment_used()
-        for i in range(amount):
-            enemies.append(et.generate(i+1, True))
+        amount = ttp.get_amount(rng)
+        enemies.extend(ttp.template.generate_many(amount, increment, rng))
     return enemies
 
 
-def _get_generated_amount():
-    return EnemyTemplate.objects.aggregate(Sum('generated'))['generated__sum']
-
-
 def spell_list(spell_type, et):
     """ Returns the list of the given type of spells for the given EnemyTemplate """
     output = []
@@ -261,40 +363,166 @@ def is_superuser(user):
 
 
 def get_statistics():
+    """ Returns the statistics snapshot. The snapshot is rebuilt with 'python manage.py update_statistics',
+        only a missing snapshot is computed on the fly.
+    """
+    try:
+        with open(_statistics_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return update_statistics()
+
+
+def update_statistics():
+    """ Computes the statistics with grouped queries and saves them as json under settings.TEMP """
+    statistics = compute_statistics()
+    path = _statistics_path()
+    tmpfile = NamedTemporaryFile(mode='w', prefix='statistics_', suffix='.json', dir=settings.TEMP, delete=False)
+    json.dump(statistics, tmpfile)
+    tmpfile.close()
+    os.replace(tmpfile.name, path)  # Readers see either the old or the new snapshot, never a partial one
+    return statistics
+
+
+def compute_statistics():
     templates = EnemyTemplate.objects.filter(published=True).exclude(race__name='Cult')
     cults = EnemyTemplate.objects.filter(published=True, race__name='Cult')
     races = Race.objects.filter(published=True)
-    races_stats = list({'name': r.name, 'id': r.id, 'template_amount': len(r.templates)} for r in races if r.templates)
-    races_stats = sorted(races_stats, reverse=True, key=lambda r: r['template_amount'])
-    users = list({'name': u.username, 'template_amount': len(templates.filter(owner=u))} for u in User.objects.all())
-    users = sorted(users, reverse=True, key=lambda item: item['template_amount'])
-    users = list(user for user in users if user['template_amount'] > 0)
-    clts = list({'name': c.name, 'id': c.id, 'rank': c.get_cult_rank_display(), 'rank_int': c.cult_rank} for c in cults)
-    clts = sorted(clts, reverse=False, key=lambda et: et['name'])
-
-    output = {'templates': templates.filter(generated__gt=29).order_by('-generated'),
+    races_stats = races.annotate(template_amount=Count('enemytemplate')).filter(template_amount__gt=0)
+    races_stats = list(races_stats.order_by('-template_amount', 'name').values('name', 'id', 'template_amount'))
+    users = templates.values('owner__username').annotate(template_amount=Count('id')).order_by('-template_amount', 'owner__username')
+    users = list({'name': u['owner__username'], 'template_amount': u['template_amount']} for u in users)
+    rank_names = dict(EnemyTemplate.cult_choices)
+    clts = list({'name': c['name'], 'id': c['id'], 'rank': rank_names.get(c['cult_rank']), 'rank_int': c['cult_rank']}
+                for c in cults.order_by('name').values('name', 'id', 'cult_rank'))
+    cult_ranks = dict(cults.order_by().values_list('cult_rank').annotate(Count('id')))
+
+    output = {'templates': list(templates.filter(generated__gt=29).order_by('-generated').values('id', 'name', 'generated')),
               'races': races_stats,
               'users': users,
               'cults': clts,
-              'total_published_templates': templates.count(),
+              'total_published_templates': sum(u['template_amount'] for u in users),
               'total_published_races': races.count(),
-              'total_published_cults': cults.count(),
-              'common_cults': cults.filter(cult_rank=1).count(),
-              'dedicated_cults': cults.filter(cult_rank=2).count(),
-              'proven_cults': cults.filter(cult_rank=3).count(),
-              'overseer_cults': cults.filter(cult_rank=4).count(),
-              'leader_cults': cults.filter(cult_rank=5).count()}
+              'total_published_cults': len(clts),
+              'common_cults': cult_ranks.get(1, 0),
+              'dedicated_cults': cult_ranks.get(2, 0),
+              'proven_cults': cult_ranks.get(3, 0),
+              'overseer_cults': cult_ranks.get(4, 0),
+              'leader_cults': cult_ranks.get(5, 0),
+              'updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}
     return output
 
 
-def save_as_html(context, template_name):
-    """ Renders the generated enemies to html and saves to disk, so that it can be converted to PDF later """
-    rendered = render_to_string(template_name, context)
-    prefix = _get_html_prefix(context)
-    htmlfile = NamedTemporaryFile(mode='w', prefix=prefix, suffix='.html', dir=settings.TEMP, delete=False)
-    htmlfile.write(rendered)
+def _statistics_path():
+    return os.path.join(settings.TEMP, 'statistics.json')
+
+
+def get_encounter(context, seed, index=None):
+    """ Returns the generated encounter of the context as a short signed string: the seed and the templates or
+        the party, and a digest of the generated enemies. The html for exports is rendered from it only when
+        needed, see save_encounter_html.
+        Input: index is the list of tuples of (EnemyTemplate, amount) the enemies were generated from
+    """
+    encounter = {'seed': seed, 'prefix': _get_html_prefix(context), 'digest': _encounter_digest(context)}
+    if context.get('party'):
+        encounter['party'] = context['party'].id
+    else:
+        encounter['templates'] = [[et.id, amount] for et, amount in index]
+        encounter['single_template'] = context.get('single_template', False)
+    return signing.dumps(encounter, salt=ENCOUNTER_SALT, compress=True)
+
+
+def save_encounter_html(encounter):
+    """ Renders the generated enemies of the encounter to html and saves to disk, so that it can be converted
+        to PDF later. The enemies are generated again with the same seed. The same encounter is saved only once,
+        so changes made to the html are kept.
+        Returns the name of the html file.
+    """
+    data, file_name = encounter_file_name(encounter)
+    if temp_store.find(file_name):
+        return file_name
+    context = _get_encounter_context(data)
+    if _encounter_digest(context) != data['digest']:
+        raise ValidationError('The templates have been changed after the enemies were generated. Please generate again.')
+    html_path = temp_store.path(file_name)
+    os.makedirs(os.path.dirname(html_path), exist_ok=True)
+    htmlfile = NamedTemporaryFile(mode='w', prefix='partial_', suffix='.html', dir=os.path.dirname(html_path), delete=False)
+    htmlfile.write(render_to_string('generated_enemies.html', context))
     htmlfile.close()
-    return os.path.basename(htmlfile.name)
+    os.replace(htmlfile.name, html_path)
+    return file_name
+
+
+def encounter_file_name(encounter):
+    """ Returns a tuple of (encounter data, name of the html file of the encounter) """
+    try:
+        data = signing.loads(encounter, salt=ENCOUNTER_SALT)
+    except signing.BadSignature:
+        raise ValidationError('Invalid encounter')
+    return data, '%s%s.html' % (data['prefix'], hashlib.sha1(encounter.encode('utf-8')).hexdigest()[:16])
+
+
+def add_sheet_edit(file_name, element_id, value):
+    """ Records a change of the given element of a generated html file. The changes are appended to a log next
+        to the html file and applied when the html is read with read_sheet. Every change is a single append,
+        so concurrent changes don't overwrite each other.
+    """
+    path = _edit_log_path(file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, (json.dumps([element_id, value]) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def read_sheet(file_name):
+    """ Returns a tuple of (path, BeautifulSoup) of the given html file with the logged changes applied """
+    html_path = get_html_path(file_name)
+    with open(html_path, 'r') as ff:
+        soup = BeautifulSoup(ff, 'html.parser')
+    edits = OrderedDict()
+    try:
+        with open(_edit_log_path(file_name), 'r') as log:
+            for line in log:
+                try:
+                    element_id, value = json.loads(line)
+                except ValueError:  # A line being written
+                    continue
+                edits.pop(element_id, None)
+                edits[element_id] = value  # Only the latest change of an element counts
+    except IOError:
+        pass
+    for element_id, value in edits.items():
+        span_tag = soup.find('span', {'id': element_id})
+        if span_tag is None:
+            continue
+        klasses = ' '.join(span_tag.get('class', []))
+        new_tag = BeautifulSoup('<span id="%s" class="%s">%s</span>' % (element_id, klasses, value), 'html.parser').span
+        span_tag.replaceWith(new_tag)
+    return html_path, soup
+
+
+def _edit_log_path(file_name):
+    return (temp_store.find(file_name) or temp_store.path(file_name)) + '.edits'
+
+
+def _get_encounter_context(data):
+    rng = random.Random(data['seed'])
+    try:
+        if 'party' in data:
+            return get_generated_party(Party.objects.get(id=data['party']), rng, increment=False)
+        templates = EnemyTemplate.objects.select_related('race').in_bulk([et_id for et_id, _ in data['templates']])
+        index = [(templates[et_id], amount) for et_id, amount in data['templates']]
+    except (Party.DoesNotExist, KeyError):
+        raise ValidationError('The templates have been deleted after the enemies were generated.')
+    return {'enemies': get_enemies(index, False, rng), 'single_template': data['single_template']}
+
+
+def _encounter_digest(context):
+    features = ['%s: %s' % (f.feature_list.name, f.name) for f in context.get('party_additional_features', [])]
+    data = as_json(context['enemies']) + json.dumps(features)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
 
 
 def _get_html_prefix(context):
@@ -311,33 +539,175 @@ def _get_html_prefix(context):
 
 
 def generate_pdf(html_path):
-    """ Generates a PDF based on the given html file """
-    html_path = os.path.join(settings.TEMP, html_path)
-    pdf_path = html_path.replace('.html', '.pdf')
-    HTML(html_path).write_pdf(pdf_path)
+    """ Generates a PDF based on the given html file. A PDF of identical html is read from the export cache """
+    html_path, soup = read_sheet(html_path)
+    html = str(soup)
+    pdf_path = _export_cache_path(html, '.pdf')
+    if not _export_cache_hit(pdf_path):
+        partial_path = _partial_export_path('.pdf')
+        HTML(string=html, base_url=html_path).write_pdf(partial_path)
+        os.replace(partial_path, pdf_path)
+        evict_export_cache()
     return pdf_path
 
 
+def enqueue_pdf_export(html_path):
+    """ Queues the PDF rendering of the given html file. The render_exports command renders the queued files """
+    return ExportJob.objects.create(html_file=html_path)
+
+
+def process_export_job():
+    """ Renders the next queued export job. Returns the job, or None if there was nothing to render """
+    job = ExportJob.claim_next()
+    if job is None:
+        return None
+    try:
+        pdf_path = generate_pdf(job.html_file)
+    except Exception as e:
+        job.finish(error='%s: %s' % (e.__class__.__name__, e))
+    else:
+        job.finish(result_file=os.path.relpath(pdf_path, settings.TEMP))
+    return job
+
+
+def delete_old_export_jobs(max_age=None):
+    """ Deletes the export jobs finished more than max_age seconds ago (default settings.EXPORT_JOB_MAX_AGE),
+        and their PDFs. Returns the amount of deleted jobs.
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'EXPORT_JOB_MAX_AGE', 24 * 3600)
+    deleted, result_files = ExportJob.delete_finished(max_age)
+    for result_file in result_files:
+        try:
+            os.remove(os.path.join(settings.TEMP, result_file))
+        except OSError:
+            pass
+    return deleted
+
+
+def export_file_name(html_path, extension):
+    """ Returns the download name of a file exported from the given html file: the unique identifier
+        and commas are removed
+    """
+    file_name = os.path.splitext(os.path.basename(html_path))[0]
+    file_name = '_'.join(file_name.split('_')[:-1])
+    file_name = file_name.replace(',', '')
+    return file_name + extension
+
+
 def generate_pngs(html_path):
-    """ Generates png-images out of the generated_html """
-    with open(os.path.join(settings.TEMP, html_path).encode('utf-8'), 'r') as ff:
-        soup = BeautifulSoup(ff, 'html.parser')
+    """ Generates png-images out of the generated_html, one per enemy. The images are rendered in parallel
+        by at most settings.PNG_RENDER_WORKERS processes. The paths are returned in the order of the enemies.
+    """
+    html_path, soup = read_sheet(html_path)
     enemies = soup.find_all('div', {'class': 'enemy_container'})
     container = soup.find('div', {'id': 'enemies'})
     pngs = []
+    jobs = []
     for enemy in enemies:
         container.clear()
         container.append(enemy)
-        htmlfile = NamedTemporaryFile(mode='w', suffix='.html', dir=settings.TEMP, delete=False)
-        htmlfile.write(soup.prettify())
-        htmlfile.close()
-        png_name = htmlfile.name.replace('.html', '.png')
-        HTML(htmlfile.name).write_png(png_name, stylesheets=[CSS(string='@media print{body, td, th{font-size: 11px !important;}}')])
-        _trim(png_name)
-        pngs.append(png_name)
+        html = str(soup)
+        png_path = _export_cache_path(html + PNG_STYLESHEET, '.png')
+        if not _export_cache_hit(png_path):
+            jobs.append((html, html_path, png_path, _partial_export_path('.png')))
+        pngs.append(png_path)
+    if len(jobs) <= 1 or _png_workers() <= 1:
+        for job in jobs:
+            _render_png(job)
+    else:
+        try:
+            list(_get_png_pool().map(_render_png, jobs))
+        except BrokenProcessPool:
+            _forget_png_pool()
+            raise
+    if jobs:
+        evict_export_cache()
     return pngs
 
 
+_png_pool = None
+
+
+def _png_workers():
+    return getattr(settings, 'PNG_RENDER_WORKERS', None) or os.cpu_count() or 1
+
+
+def _get_png_pool():
+    """ Returns the process pool rendering the PNGs, shared by the requests of this process. The pool is created
+        on first use. Its workers are spawned, not forked, so they don't inherit the database connections
+        and threads of the web server process.
+    """
+    global _png_pool
+    if _png_pool is None:
+        _png_pool = ProcessPoolExecutor(max_workers=_png_workers(), mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=django.setup)
+    return _png_pool
+
+
+def _forget_png_pool():
+    global _png_pool
+    if _png_pool is not None:
+        _png_pool.shutdown(wait=False)
+    _png_pool = None
+
+
+def _render_png(job):
+    """ Renders one enemy. job is a tuple of (html string, base url for the relative links, png path, path for
+        the unfinished png)
+    """
+    html, base_url, png_path, partial_path = job
+    HTML(string=html, base_url=base_url).write_png(partial_path, stylesheets=[CSS(string=PNG_STYLESHEET)])
+    _trim(partial_path)
+    os.replace(partial_path, png_path)
+    return png_path
+
+
+def _export_cache_dir():
+    path = os.path.join(settings.TEMP, EXPORT_CACHE)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _export_cache_path(content, extension):
+    """ Exports are stored by the hash of their html and the stylesheet version. Bump
+        settings.EXPORT_STYLESHEET_VERSION when the stylesheets change.
+    """
+    key = hashlib.sha256(('%s%s' % (getattr(settings, 'EXPORT_STYLESHEET_VERSION', 1), extension)).encode('utf-8'))
+    key.update(content if isinstance(content, bytes) else content.encode('utf-8'))
+    path = temp_store.path(key.hexdigest() + extension, EXPORT_CACHE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _partial_export_path(extension):
+    """ Unfinished exports are written to a partial file and renamed when ready, so that a cached export is
+        always complete
+    """
+    partial = NamedTemporaryFile(prefix='partial_', suffix=extension, dir=_export_cache_dir(), delete=False)
+    partial.close()
+    return partial.name
+
+
+def _export_cache_hit(path):
+    """ Checks whether the export is cached and updates the hit counters. A hit is marked as recently used """
+    if not temp_store.touch(path):
+        Counter.add('export_cache_misses', 1)
+        return False
+    Counter.add('export_cache_hits', 1)
+    return True
+
+
+def evict_export_cache(max_bytes=None):
+    """ Deletes the least recently used exports until the cache fits in settings.EXPORT_CACHE_MAX_BYTES.
+        Returns the amount of deleted files.
+    """
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'EXPORT_CACHE_MAX_BYTES', 500 * 1024 * 1024)
+    deleted, _ = temp_store.sweep(max_bytes=max_bytes, area=EXPORT_CACHE)
+    return deleted
+
+
 def as_json(enemies):
     """ Input: A list of generated enemies. Output: The enemies as a json string """
     out = []
@@ -385,7 +755,12 @@ def sanitize_html_path(html_path):
     if file_name != html_path or os.path.splitext(file_name)[1].lower() != '.html':
         return None
     temp_root = os.path.abspath(settings.TEMP)
-    full_path = os.path.abspath(os.path.join(temp_root, file_name))
-    if os.path.commonpath([temp_root, full_path]) != temp_root or not os.path.isfile(full_path):
+    full_path = temp_store.find(file_name)
+    if not full_path or os.path.commonpath([temp_root, os.path.abspath(full_path)]) != temp_root:
         return None
     return file_name
+
+
+def get_html_path(file_name):
+    """ Returns the path of a html file saved with save_encounter_html """
+    return temp_store.find(file_name) or os.path.join(settings.TEMP, file_name)
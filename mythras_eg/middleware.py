@@ -7,6 +7,10 @@ PUBLIC_CORS_PATHS = (
     "/party_index_json/",
     "/generate_enemies_json/",
     "/generate_party_json/",
+    "/generate_encounter_json/",
+)
+PUBLIC_CORS_POST_PATHS = (
+    "/generate_encounter_json/",
 )
 
 
@@ -18,13 +22,13 @@ class SimpleCorsMiddleware:
     def __call__(self, request):
         if self._is_public_cors_path(request.path) and request.method == "OPTIONS":
             response = HttpResponse(status=204)
-            self._add_public_cors_headers(response)
+            self._add_public_cors_headers(request, response)
             return response
 
         response = self.get_response(request)
 
         if self._is_public_cors_path(request.path):
-            self._add_public_cors_headers(response)
+            self._add_public_cors_headers(request, response)
         elif request.META.get("HTTP_ORIGIN") in self.allowed_origins:
             origin = request.META.get("HTTP_ORIGIN")
             response["Access-Control-Allow-Origin"] = origin
@@ -37,11 +41,14 @@ class SimpleCorsMiddleware:
 
         return response
 
-    def _is_public_cors_path(self, path):
+    def _is_public_cors_path(self, path, public_paths=PUBLIC_CORS_PATHS):
         path = path.split("?", 1)[0]
-        return any(path.endswith(public_path) for public_path in PUBLIC_CORS_PATHS)
+        return any(path.endswith(public_path) for public_path in public_paths)
 
-    def _add_public_cors_headers(self, response):
+    def _add_public_cors_headers(self, request, response):
         response["Access-Control-Allow-Origin"] = "*"
-        response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+        if self._is_public_cors_path(request.path, PUBLIC_CORS_POST_PATHS):
+            response["Access-Control-Allow-Methods"] = "POST, OPTIONS"
+        else:
+            response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
         response["Access-Control-Allow-Headers"] = "Accept, Content-Type"
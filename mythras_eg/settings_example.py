@@ -121,3 +121,29 @@ LOGGING = {
 }
 
 TEMP = os.path.join(PROJECT_ROOT, 'temp')
+
+# The tag lists and changelog date of the sidebar and the listing json are cached. Their cache keys contain versions
+# kept in the database, so a per-process cache stays correct with several worker processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+SIDEBAR_CACHE_TIMEOUT = 3600  # seconds
+CATALOG_CACHE_TIMEOUT = 3600  # seconds, the json of the template and party listings
+SEARCH_PAGE_SIZE = 100  # Default and maximum number of search results per request
+
+# PDF exports are rendered by 'python manage.py render_exports'
+EXPORT_WORKERS = 2  # Maximum number of concurrent renderings
+EXPORT_JOB_TIMEOUT = 300  # seconds. Jobs running longer are queued again by render_exports
+EXPORT_JOB_MAX_AGE = 24 * 3600  # seconds. Older finished jobs and their PDFs are deleted by sweep_temp
+PNG_RENDER_WORKERS = 4  # Processes in the PNG rendering pool of each web server process, spawned on first export. None: one per core
+# Exports are cached under TEMP/export_cache by the hash of their html. Bump the version when the stylesheets change.
+EXPORT_STYLESHEET_VERSION = 1
+EXPORT_CACHE_MAX_BYTES = 500 * 1024 * 1024
+# Files under TEMP are deleted by 'python manage.py sweep_temp' when not used within TEMP_TTL seconds, or when the
+# files take more than TEMP_MAX_BYTES (least recently used first). With TEMP_SWEEP_INTERVAL the command keeps running.
+TEMP_TTL = 7 * 24 * 3600
+TEMP_MAX_BYTES = 2 * 1024 * 1024 * 1024
+TEMP_SWEEP_INTERVAL = None  # seconds
+GENERATE_JSON_MAX_AMOUNT = 10000  # Maximum amount of enemies per generate_enemies_json request
@@ -44,6 +44,49 @@ ExecStart=/meg/venv/bin/gunicorn --access-logfile - \
 WantedBy=multi-user.target
 EOF
 
+# PDF exports are rendered only while render_exports is running
+sudo cat > /etc/systemd/system/render_exports.service <<EOF
+[Unit]
+Description=PDF export workers
+After=network.target mariadb.service
+
+[Service]
+User=meg
+Group=www-data
+WorkingDirectory=/meg
+ExecStart=/meg/venv/bin/python manage.py render_exports
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+sudo cat > /etc/systemd/system/sweep_temp.service <<EOF
+[Unit]
+Description=Delete old files under TEMP and old export jobs
+
+[Service]
+Type=oneshot
+User=meg
+Group=www-data
+WorkingDirectory=/meg
+ExecStart=/meg/venv/bin/python manage.py sweep_temp
+EOF
+
+sudo cat > /etc/systemd/system/sweep_temp.timer <<EOF
+[Unit]
+Description=Run sweep_temp hourly
+
+[Timer]
+OnCalendar=hourly
+Persistent=true
+
+[Install]
+WantedBy=timers.target
+EOF
+
 
 sudo systemctl start gunicorn.socket
 sudo systemctl enable gunicorn.socket
+sudo systemctl enable --now render_exports.service
+sudo systemctl enable --now sweep_temp.timer
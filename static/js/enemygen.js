@@ -132,8 +132,14 @@ async function toggle_star(event) {
     toggle_star_callback(result.data, event.target)
 }
 
+var search_params = null;
+var search_found = 0;
+
 function search_callback(result) {
-    $('div#results_number').html(result.results.length + ' templates found.');
+    search_found += result.results.length;
+    search_params.cursor = result.next;
+    $('div#results_number').html(search_found + ' templates found.');
+    if (result.next) $('div#results_number').append(' <button id="more_results">Show more</button>');
     $('#search_results_table tbody').html('');
     var table = $('#enemy_template_list');
     $('div#searching').hide()
@@ -179,8 +185,16 @@ async function search() {
     $('#enemy_template_list').show();
     set_template_list_height();
     $('div#searching').show();
-    var data = { 'string': string, 'rank_filter': rank_filter, 'cult_rank_filter': cult_rank_filter }
-    const res = await axios.get('/rest/search/', { params: data });
+    search_params = { 'string': string, 'rank_filter': rank_filter, 'cult_rank_filter': cult_rank_filter };
+    search_found = 0;
+    const res = await axios.get('/rest/search/', { params: search_params });
+    search_callback(res.data);
+}
+
+async function search_more() {
+    $('button#more_results').remove();
+    $('div#searching').show();
+    const res = await axios.get('/rest/search/', { params: search_params });
     search_callback(res.data);
 }
 
@@ -354,6 +368,9 @@ $(document).ready(function () {
         toggle_star(event);
     })
 
+    $('div#results_number').on('click', 'button#more_results', function (event) {
+        search_more();
+    });
     $('button#search_button').click(function (event) {
         search();
     });
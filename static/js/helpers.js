@@ -74,12 +74,12 @@ function initialize_enemy_list(){
     table.rendertable();
 
     set_template_list_height();
-    $(window).resize(function(event){
+    // Called again for every appended page of search results, so the handlers are unbound before binding
+    $(window).off('resize.enemy_list').on('resize.enemy_list', function(event){
         set_template_list_height();
     });
 
-    $('input.enemy_amount').keyup(bind_amount_listeners);
-    $('input.enemy_amount').change(bind_amount_listeners);
+    $('input.enemy_amount').off('keyup change', bind_amount_listeners).on('keyup change', bind_amount_listeners);
 
     if ($('#enemy_template_list tr').length < 2){
         $('#enemy_template_list').hide();